@@ -15,22 +15,51 @@
 import re
 import os
 import json
-from time import sleep
+from functools import partial, lru_cache
+from itertools import product, count
+from math import ceil
+from queue import Queue
+from threading import Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, perf_counter
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from pathlib import Path
 from dotenv import load_dotenv
-from atcodertools.common.logging import logger_io, logger
-from atcodertools.codegen.template_engine import render
-from onlinejudge_command.main import get_parser as oj_get_parser, run_program as oj_run_program
+from jinja2 import Environment
+from atcodertools.common.logging import logger
+from atcodertools.common.language import PYTHON
+from onlinejudge import dispatch
+from onlinejudge.type import LanguageId, NotLoggedInError, SampleParseError, SubmissionError
 import requests
-from atcoder_auto_submitter.atcoder import get_prompt, get_template
+from atcoder_auto_submitter.atcoder import get_prompt, get_template, translate_statement, login, \
+    check_login
+from atcoder_auto_submitter.session import ATCODER_URL, get_session
+from atcoder_auto_submitter.scheduler import backoff
+from atcoder_auto_submitter.fingerprint import get_fingerprint
+from atcoder_auto_submitter.checker import OK, BROKEN, check_code
+from atcoder_auto_submitter.verifier import Verifier
+from atcoder_auto_submitter.judge import UNPENALIZED_VERDICTS, wait_for_verdict
+from atcoder_auto_submitter.runner import TIME_LIMIT, MEMORY_LIMIT, preload, run_tests
+from atcoder_auto_submitter.timeline import Timeline
+from atcoder_auto_submitter.execution_log import get_execution_log, propagate
+from atcoder_auto_submitter.cache import load_tests, create_tests_dir, store_tests, \
+    get_completions_digest, load_completions, store_completions
 
 load_dotenv(dotenv_path=Path.home() / '.config/atcoder-auto-submitter/.env')
 OPENAI_TOKEN = os.getenv('OPENAI_TOKEN')
 
 dirname = Path(__file__).parent
 
-def get_completions(prompt, token, testcases, completion_endpoint, completion_parameter):
+ADDITIONAL_LIBRARIES = ['math', 're', 'bisect', 'collections', 'heapq',
+                        'itertools', 'functools', 'fractions', 'numpy as np', 'numpy']
+# Rounds of completion failing in a row before the job gives up
+MAX_COMPLETION_FAILURES = 5
+# Size of the candidates embedded into a submission, along with the execution log
+MAX_SUMMARY_SIZE = 64 * 1024
+
+
+def stream_completions(prompt, token, testcases, completion_endpoint, completion_parameter,
+                       timeline=None, cancelled=None):
   data = {
       **completion_parameter,
       "prompt": prompt,
@@ -47,32 +76,175 @@ def get_completions(prompt, token, testcases, completion_endpoint, completion_pa
   }
 
   logger.info('Getting completion from OpenAI Codex...')
-  # TODO: Process as stream
-  with requests.post(completion_endpoint, json=data, headers=headers) as req:
-    response_data = req.text
-  logger.info('Successfully retrieved completion data from OpenAI Codex.')
 
   outputs = {}
+  finish_reasons = {}
+  finished = set()
+
+  session = get_session(completion_endpoint)
+  started_at = perf_counter()
+  first_byte = True
+  with session.post(completion_endpoint, json=data, headers=headers, stream=True) as req:
+    req.raise_for_status()
+    req.encoding = 'utf-8'
+    # chunk_size=None yields the SSE events as soon as they arrive
+    for line in req.iter_lines(chunk_size=None, decode_unicode=True):
+      # Checked for every line, so that the connection is closed without waiting for a candidate
+      if cancelled is not None and cancelled():
+        return
+      if len(line) == 0:
+        continue
+      if first_byte and timeline is not None:
+        timeline.add('ttfb', started_at, perf_counter(), args=dict(endpoint=completion_endpoint))
+      first_byte = False
+      json_data = line.removeprefix('data: ')
+      if json_data == '[DONE]':
+        break
 
-  for line in response_data.splitlines():
-    if len(line) == 0:
-      continue
-    json_data = line.removeprefix('data: ')
-    if json_data == '[DONE]':
-      continue
+      data = json.loads(json_data)
+      choices = data['choices'] or []
 
-    data = json.loads(json_data)
-    choices = data['choices'] or []
+      for choice in choices:
+        index = choice['index']
+        if index in finished:
+          continue
 
-    for choice in choices:
-      if choice['index'] not in outputs:
-        outputs[choice['index']] = ''
+        outputs[index] = outputs.get(index, '') + choice['text']
+        finish_reasons[index] = choice.get('finish_reason')
 
-      outputs[choice['index']] += choice['text']
+        # Emit the candidate as soon as the body of solve function is closed
+        end = get_function_end(outputs[index])
+        if end is not None:
+          outputs[index] = outputs[index][:end]
+        if end is not None or choice.get('finish_reason') is not None:
+          finished.add(index)
+          logger.info(f'Candidate {index} completed.')
+          yield index, outputs[index], finish_reasons[index]
+
+      if len(finished) == testcases:
+        break
+
+  for index, output in outputs.items():
+    if index not in finished:
+      yield index, output, finish_reasons[index]
 
   logger.info(f'Successfully extracted {len(outputs)} candidates from completion.')
 
-  return list(outputs.values())
+
+def stream_cached_completions(prompt, token, testcases, completion_endpoint, completion_parameter,
+                              completion_cache='off', timeline=None, cancelled=None):
+  digest = get_completions_digest(prompt, testcases, completion_endpoint, completion_parameter)
+
+  if completion_cache != 'off':
+    cached = load_completions(digest)
+    if cached is not None:
+      logger.info(f'Using {len(cached)} cached candidates from completion.')
+      yield from cached
+      # With `refresh`, the cached candidates are served while the fresh ones are being generated
+      if completion_cache != 'refresh':
+        return
+
+  completions = []
+  for completion in stream_completions(prompt, token, testcases, completion_endpoint,
+                                       completion_parameter, timeline, cancelled):
+    completions.append(completion)
+    yield completion
+
+  # Not reached when the stream is closed halfway, so that only complete results are stored
+  if completion_cache != 'off' and not (cancelled is not None and cancelled()):
+    store_completions(digest, completions)
+
+
+def get_completion_requests(testcases, completion_endpoints, completion_parameter, split=1):
+  # Parameters given as a list fan out into one request for each value
+  keys = [key for key, value in completion_parameter.items() if isinstance(value, list)]
+  variants = [dict(zip(keys, values))
+              for values in product(*(completion_parameter[key] for key in keys))]
+
+  completion_requests = []
+  for completion_endpoint in completion_endpoints:
+    for variant in variants:
+      completion_requests.extend(
+          [(completion_endpoint, {**completion_parameter, **variant})] * split)
+
+  n = max(ceil(testcases / len(completion_requests)), 1)
+  return [(completion_endpoint, parameter, n)
+          for completion_endpoint, parameter in completion_requests]
+
+
+def stream_hedged_completions(prompt, token, testcases, completion_endpoints, completion_parameter,
+                              split=1, completion_cache='off', cancel=None, timeline=None):
+  completion_requests = get_completion_requests(testcases, completion_endpoints,
+                                                completion_parameter, split)
+  if len(completion_requests) > 1:
+    logger.info(f'Racing {len(completion_requests)} completion requests...')
+
+  outputs = Queue()
+  closed = Event()
+  errors = []
+
+  def cancelled():
+    return closed.is_set() or (cancel is not None and cancel.is_set())
+
+  def produce(offset, completion_endpoint, parameter, n):
+    started_at = perf_counter()
+    try:
+      results = stream_cached_completions(prompt, token, n, completion_endpoint, parameter,
+                                          completion_cache, timeline, cancelled)
+      for index, output, finish_reason in results:
+        if cancelled():
+          break
+        if timeline is not None:
+          timeline.add('completion', started_at, perf_counter(),
+                       args=dict(candidate=offset + index, finish_reason=finish_reason))
+        outputs.put((offset + index, output, finish_reason))
+      # Closing the stream also closes the connection, so that the server stops generating
+      results.close()
+    except Exception as e:
+      logger.error(f'Completion from {completion_endpoint} failed: {e}')
+      errors.append(e)
+    finally:
+      outputs.put(None)
+
+  offset = 0
+  for completion_endpoint, parameter, n in completion_requests:
+    Thread(target=propagate(produce), name=f'completion {offset}', daemon=True,
+           args=(offset, completion_endpoint, parameter, n)).start()
+    offset += n
+
+  try:
+    remaining = len(completion_requests)
+    while remaining > 0:
+      output = outputs.get()
+      if output is None:
+        remaining -= 1
+      else:
+        yield output
+    # A failed request is covered by the others, but the caller is told when all of them failed
+    if len(errors) == len(completion_requests):
+      raise errors[-1]
+  finally:
+    closed.set()
+
+
+def get_completions(prompt, token, testcases, completion_endpoints, completion_parameter, split=1,
+                    completion_cache='off', timeline=None):
+  outputs = {}
+  for index, output, finish_reason in stream_hedged_completions(
+          prompt, token, testcases, completion_endpoints, completion_parameter, split,
+          completion_cache, timeline=timeline):
+    outputs[index] = output, finish_reason
+  return [outputs[index] for index in sorted(outputs)]
+
+
+def get_function_end(output):
+  # The first character of a line is enough to tell the dedent, even if the line is incomplete
+  offset = 0
+  for line in output.splitlines(keepends=True):
+    if len(line.strip()) > 0 and line[0] != ' ' and line[0] != '\t':
+      return offset
+    offset += len(line)
+  return None
 
 
 def get_function(solve_function_definition, output):
@@ -89,179 +261,490 @@ def get_function(solve_function_definition, output):
   return '\n'.join(ret)
 
 
-def get_fingerprint(func):
-  func = re.sub(r'#.+$', '', func, flags=re.M)
-  func = re.sub(r'[\s()]', '', func)
-  return func
+def log_clusters(clusters):
+  total = sum(clusters.values())
+  logger.info(f'Clustered {total} candidates into {len(clusters)} clusters. '
+              f'{total - len(clusters)} verification runs saved.')
 
 
-def submit_code(code, execution_log, candidates, choice, contest, problem_id):
-  with open(dirname / 'template.py.jinja') as f:
-    template = f.read()
-  execution_log = re.sub(r"'+", "'", execution_log)
+def get_code(result, notag_prompt, outro_lines):
+  outro = ''.join(outro_lines)
+  if 'print' not in result:
+    outro = re.sub(r'^(\s*)(solve\(.*\))$', r'\1print(\2)', outro, flags=re.M)
+  header = ''.join(map(lambda l: f'import {l}\n', ADDITIONAL_LIBRARIES))
+  return header + notag_prompt + result + outro
 
-  submission = render(template, code=code, execution_log=execution_log,
-                      candidates=candidates, choice=choice)
 
-  with NamedTemporaryFile() as f:
-    filename = f.name
-    f.write(submission.encode())
+def get_problem_url(contest, problem_id):
+  return f'{ATCODER_URL}contests/{contest}/tasks/{contest}_{problem_id}'
 
-    args = ['submit', f'https://atcoder.jp/contests/{contest}/tasks/{contest}_{problem_id}',
-            filename, '--wait', '0', '--yes', '--language', 'python']
 
-    parser = oj_get_parser()
-    parsed = parser.parse_args(args=args)
-    return oj_run_program(parsed, parser=parser)
+@lru_cache(maxsize=None)
+def get_language_id(url):
+  problem = dispatch.problem_from_url(url)
+  languages = problem.get_available_languages(session=get_session(url))
+  for language in languages:
+    if PYTHON.submission_lang_pattern.match(language.name):
+      logger.info(f'Chosen language: {language.name} ({language.id})')
+      return language.id
+  raise Exception('Python is not available in this contest')
 
 
-def download_tests(contest, problem_id):
-  url = f'https://atcoder.jp/contests/{contest}/tasks/{contest}_{problem_id}'
+@lru_cache(maxsize=None)
+def get_submission_template():
+  with open(dirname / 'template.py.jinja') as f:
+    return Environment(trim_blocks=True, lstrip_blocks=True).from_string(f.read())
+
+
+def get_candidates_summary(candidates, count=None, max_size=MAX_SUMMARY_SIZE):
+  # The latest of the first `count` candidates fitting in max_size with their indices, like the
+  # snapshot of the execution log. The list is shared by the job, so it's never copied as a whole.
+  count = len(candidates) if count is None else count
+  summary = []
+  size = 0
+  for index in reversed(range(count)):
+    size += len(candidates[index]) + 1
+    if size > max_size:
+      break
+    summary.append((index, candidates[index]))
 
-  testdir = TemporaryDirectory()
-  args = ['download', url, '--directory', testdir.name]
+  summary.reverse()
+  return summary
 
-  parser = oj_get_parser()
-  while True:
-    logger.info('Downloading test cases...')
-    exit_code = oj_run_program(parser.parse_args(args=args), parser=parser)
-    if exit_code == 0:
+
+def render_submission(code, execution_log, candidates, choice):
+  # execution_log is a list of the records, which are already sanitized for the string literal,
+  # and candidates is a summary of the candidates as (index, candidate)
+  omitted = candidates[0][0] if len(candidates) > 0 else 0
+  return get_submission_template().render(code=code, execution_log=execution_log,
+                                          candidates=candidates, omitted=omitted,
+                                          choice=choice) + '\n'
+
+
+def submit_code(code, execution_log, candidates, choice, contest, problem_id):
+  submission = render_submission(code, execution_log, candidates, choice)
+
+  # Submits with the logged-in session of atcoder-tools over the pooled connections
+  login()
+  url = get_problem_url(contest, problem_id)
+  problem = dispatch.problem_from_url(url)
+  try:
+    result = problem.submit_code(submission.encode(), language_id=LanguageId(get_language_id(url)),
+                                 session=get_session(url))
+  except (NotLoggedInError, SubmissionError, requests.RequestException) as e:
+    logger.error(f'Submission failed: {e!r}')
+    return None
+
+  logger.info(f'Submitted: {result.get_url()}')
+  return result.submission_id
+
+
+def submit_with_retries(timeline, code, candidates, choice, contest, problem_id):
+  for attempt in count(1):
+    with timeline.stage('submit_code', candidate=choice, attempt=attempt) as stage:
+      execution_log = get_execution_log().snapshot()
+      summary = get_candidates_summary(candidates)
+      submission_id = submit_code(code, execution_log, summary, choice, contest, problem_id)
+      stage['submission_id'] = submission_id
+    if submission_id is not None:
       break
-    logger.info('Test case extraction failed. Trying after 0.5s...')
+    logger.info('Submission failed. Trying after 0.5s...')
     sleep(0.5)
 
-  logger.info('Test cases downloaded.')
+  logger.info('Submission succeeded.')
+  return submission_id
+
+
+def judge_submission(timeline, contest, choice, submission_id):
+  with timeline.stage('judge', candidate=choice, submission_id=submission_id) as stage:
+    verdict = wait_for_verdict(contest, submission_id)
+    stage['verdict'] = verdict
+  logger.info(f'Verdict of candidate {choice}: {verdict}')
+  return verdict
+
+
+def report_verdict(events, timeline, contest, choice, submission_id):
+  events.put(('verdict', (choice, judge_submission(timeline, contest, choice, submission_id))))
+
+
+def download_tests(contest, problem_id, timeline=None):
+  timeline = timeline or Timeline(f'{contest}_{problem_id}')
+
+  with timeline.stage('download_tests') as stage:
+    testdir = load_tests(contest, problem_id)
+    stage['cached'] = testdir is not None
+    if testdir is not None:
+      logger.info(f'Using cached test cases in {testdir}')
+      return testdir
 
+    testdir = fetch_tests(contest, problem_id, stage)
+
+  logger.info(f'Test cases downloaded to {testdir}')
   return testdir
 
 
-def verify_code(code, execution_log, candidates, choice, testdir):
-  with open(dirname / 'template.py.jinja') as f:
-    template = f.read()
-  execution_log = re.sub(r"'+", "'", execution_log)
+def fetch_tests(contest, problem_id, stage):
+  login()
+  url = get_problem_url(contest, problem_id)
+  problem = dispatch.problem_from_url(url)
+
+  # The task page may be unavailable for a moment right after the beginning of the contest
+  for attempt, delay in enumerate(backoff(), 1):
+    logger.info('Downloading test cases...')
+    try:
+      samples = problem.download_sample_cases(session=get_session(url))
+      if len(samples) > 0:
+        break
+    except (SampleParseError, requests.RequestException) as e:
+      logger.info(f'Test case download failed: {e!r}')
+    logger.info(f'Test case extraction failed. Trying after {delay:.2f}s...')
+    sleep(delay)
+  stage.update(attempts=attempt, samples=len(samples))
+
+  testdir = create_tests_dir()
+  for sample in samples:
+    (testdir / f'{sample.name}.in').write_bytes(sample.input_data)
+    (testdir / f'{sample.name}.out').write_bytes(sample.output_data)
+
+  return store_tests(contest, problem_id, testdir)
+
 
-  submission = render(template, code=code, execution_log=execution_log,
-                      candidates=candidates, choice=choice)
+def verify_code(code, execution_log, candidates, choice, testdir, runner='oj', jobs=1):
+  submission = render_submission(code, execution_log, candidates, choice)
 
-  with NamedTemporaryFile() as f:
-    filename = f.name
-    f.write(submission.encode())
+  logger.info(f'Verifying candidate {choice}...')
 
-    args = ['test', '--command', f'python {filename}',
-            '--directory', testdir.name, '--mle', '50', '--tle', '1']
+  if runner == 'warm':
+    exit_code, samples = run_tests(submission, testdir, TIME_LIMIT, MEMORY_LIMIT, jobs)
+  else:
+    from onlinejudge_command.main import get_parser as oj_get_parser, run_program as oj_run_program
 
-    parser = oj_get_parser()
-    logger.info(f'Verifying candidate {choice}...')
-    exit_code = oj_run_program(parser.parse_args(args=args), parser=parser)
+    with NamedTemporaryFile() as f, TemporaryDirectory() as log_dir:
+      filename = f.name
+      f.write(submission.encode())
+      f.flush()
+
+      # The results of samples are written to the log file by oj test
+      log_file = Path(log_dir, 'test.json')
+      args = ['test', '--command', f'python {filename}', '--directory', str(testdir),
+              '--mle', str(MEMORY_LIMIT), '--tle', str(TIME_LIMIT), '--log-file', str(log_file)]
+      # oj test runs all the samples even after a failure, unlike the warm runner
+      if jobs > 1:
+        args += ['--jobs', str(jobs)]
+
+      parser = oj_get_parser()
+      exit_code = oj_run_program(parser.parse_args(args=args), parser=parser)
+
+      history = json.loads(log_file.read_text()) if log_file.exists() else []
+      samples = [dict(name=result['testcase']['name'], verdict=result['status'],
+                      elapsed=result['elapsed'], memory=result['memory']) for result in history]
 
   logger.info(f'Verification finished. exit code = {exit_code}')
-  return exit_code
+  return exit_code, samples
 
 
 def run_without_test(problem_id,
-                     contest_id, testcases, completion_endpoint, completion_parameter, language,
-                     translate):
+                     contest_id, testcases, completion_endpoints, completion_parameter, language,
+                     translate, fast_template=True, template=None, split=1, completion_cache='off',
+                     timeline=None, trace_dir=None, penalty_budget=0):
   if OPENAI_TOKEN is None:
     logger.critical('OPENAI_TOKEN is not set')
     exit(1)
 
   logger.info(f'job started (contest = {contest_id}, problem id = {problem_id})')
-  en_statement_lines, intro_lines, solve_function_definition, outro_lines = get_template(
-      contest_id, problem_id, language, translate)
-  prompt, notag_prompt = get_prompt(en_statement_lines, intro_lines, solve_function_definition)
-
-  results = get_completions(prompt, OPENAI_TOKEN, testcases,
-                            completion_endpoint, completion_parameter)
-  fingerprints = set()
+  timeline = timeline or Timeline(f'{contest_id}_{problem_id}')
+  if template is None:
+    template = get_template(contest_id, problem_id, language, translate, fast_template, timeline)
+  en_statement_lines, intro_lines, solve_function_definition, outro_lines = template
+  with timeline.stage('get_prompt'):
+    prompt, notag_prompt = get_prompt(en_statement_lines, intro_lines, solve_function_definition)
+
+  with timeline.stage('get_completions'):
+    results = get_completions(prompt, OPENAI_TOKEN, testcases, completion_endpoints,
+                              completion_parameter, split, completion_cache, timeline)
+  clusters = {}
   all_candidates = []
-  candidates = []
 
   logger.info(f'Generating function and fingerprints...')
-  for i, result in enumerate(results):
+  for i, (result, finish_reason) in enumerate(results):
     func = get_function(solve_function_definition, result)
     fingerprint = get_fingerprint(func)
     all_candidates.append(func)
-    if fingerprint not in fingerprints and len(func) < 800:
-      candidates.append((i, result))
-      fingerprints.add(fingerprint)
+    if len(func) < 800:
+      code = get_code(result, notag_prompt, outro_lines)
+      severity, reason = check_code(code, finish_reason)
+      if severity != OK:
+        logger.info(f'Candidate {i} failed the static check: {reason}')
+      clusters.setdefault(fingerprint, []).append((severity, i, code))
+
+  # Without the tests, the most common one among the candidates passing the static check is the
+  # most likely to be correct. Ties are kept in the original order.
+  candidates = [cluster[0] for cluster in
+                sorted(clusters.values(), key=lambda cluster: (cluster[0][0], -len(cluster)))]
+  logger.info(f'Clustered {sum(map(len, clusters.values()))} candidates '
+              f'into {len(clusters)} clusters.')
+
+  chosen_candidates = [candidate for candidate in candidates if candidate[0] != BROKEN]
+  if len(chosen_candidates) == 0:
+    logger.error('No candidate passed the static check. Giving up the submission.')
+    return
+
+  # With the penalty budget, the next cluster is submitted when the judge rejects the previous one
+  penalties = 0
+  for _, choice, code in chosen_candidates:
+    submission_id = submit_with_retries(timeline, code, all_candidates, choice, contest_id,
+                                        problem_id)
+    if penalty_budget == 0:
+      break
 
-  chosen_candidates = candidates[0:1]
+    verdict = judge_submission(timeline, contest_id, choice, submission_id)
+    if verdict == 'AC' or verdict is None:
+      break
+    if verdict not in UNPENALIZED_VERDICTS:
+      penalties += 1
+    if penalties > penalty_budget:
+      logger.warning(f'Penalty budget of {penalty_budget} is exhausted. Giving up.')
+      break
+    logger.info(f'Submitting the next candidate... (penalties: {penalties}/{penalty_budget})')
 
-  execution_log = logger_io.getvalue()
+  timeline.log()
+  if trace_dir is not None:
+    timeline.export(trace_dir)
 
-  for choice, result in chosen_candidates:
-    outro = ''.join(outro_lines)
-    if 'print' not in result:
-      outro = re.sub(r'^(\s*)(solve\(.*\))$', r'\1print(\2)', outro, flags=re.M)
-    additional_libraries = ['math', 're', 'bisect', 'collections', 'heapq',
-                            'itertools', 'functools', 'fractions', 'numpy as np', 'numpy']
-    header = ''.join(map(lambda l: f'import {l}\n', additional_libraries))
-    code = header + notag_prompt + result + outro
 
-    while True:
-      exit_code = submit_code(code, execution_log, all_candidates, choice, contest_id, problem_id)
-      if exit_code == 0:
-        break
-      logger.info('submission failed. Trying after 0.5s...')
-      sleep(0.5)
+def prewarm(completion_endpoints):
+  logger.info('Warming up connections...')
+
+  for completion_endpoint in completion_endpoints:
+    try:
+      # Only the connection matters, so the response of the endpoint is ignored
+      get_session(completion_endpoint).head(completion_endpoint, timeout=5)
+    except requests.RequestException as e:
+      logger.warning(f'Failed to connect to {completion_endpoint}: {e}')
+
+  if check_login():
+    logger.info('Logged in to AtCoder.')
+
+
+def produce_candidates(events, cancel, timeline, notag_prompt, *args, delay=0, **kwargs):
+  error = None
+  try:
+    # A round after a failure waits for the delay, lest a failing endpoint be flooded
+    if cancel.wait(delay):
+      return
+    with timeline.stage('get_completions'):
+      results = stream_hedged_completions(*args, **kwargs, cancel=cancel, timeline=timeline)
+      for i, (_, result, finish_reason) in enumerate(results):
+        if cancel.is_set():
+          break
+        if i == 0:
+          timeline.mark('first completion')
+        # The code of a candidate is built on the prompt it was completed from
+        events.put(('candidate', (result, finish_reason, notag_prompt)))
+      results.close()
+  except Exception as e:
+    logger.error(f'Completion failed: {e}')
+    error = e
+  finally:
+    events.put(('completed', error))
 
-    logger.info('submission succeeded.')
+
+def report_translation(events, timeline, statement_lines):
+  try:
+    events.put(('translated', translate_statement(statement_lines, timeline)))
+  except Exception as e:
+    logger.error(f'Translation failed: {e}')
 
 
 def run_with_test(problem_id,
-                  contest_id, testcases, completion_endpoint, completion_parameter, language,
-                  translate):
+                  contest_id, testcases, completion_endpoints, completion_parameter, language,
+                  translate, runner='oj', fast_template=True, template=None, split=1,
+                  completion_cache='off', timeline=None, trace_dir=None, penalty_budget=0,
+                  jobs=1, cores=None):
   if OPENAI_TOKEN is None:
     logger.critical('OPENAI_TOKEN is not set')
     exit(1)
 
   logger.info(f'job started (contest = {contest_id}, problem id = {problem_id})')
-  en_statement_lines, intro_lines, solve_function_definition, outro_lines = get_template(
-      contest_id, problem_id, language, translate)
-  prompt, notag_prompt = get_prompt(en_statement_lines, intro_lines, solve_function_definition)
-
-  while True:
-    results = get_completions(prompt, OPENAI_TOKEN, testcases,
-                              completion_endpoint, completion_parameter)
-    fingerprints = set()
+  timeline = timeline or Timeline(f'{contest_id}_{problem_id}')
+  events = Queue()
+
+  # Test cases only depend on the problem, so they are downloaded while the prompt is processed
+  executor = ThreadPoolExecutor(max_workers=2)
+  verifier = None
+  cancel = Event()
+  try:
+    tests_future = executor.submit(propagate(download_tests), contest_id, problem_id, timeline)
+    tests_future.add_done_callback(lambda _: events.put(('tests', None)))
+
+    if runner == 'warm':
+      # Pool workers are forked from this process, so they start with the libraries already imported
+      preload_future = executor.submit(propagate(timeline.run), 'preload', preload,
+                                       ADDITIONAL_LIBRARIES)
+
+    # With translation, the completion starts on the original statement without waiting for the
+    # translation, and the translated statement joins as another stream of candidates
+    if template is None:
+      template = get_template(contest_id, problem_id, language, False, fast_template, timeline)
+    en_statement_lines, intro_lines, solve_function_definition, outro_lines = template
+    with timeline.stage('get_prompt'):
+      prompt, notag_prompt = get_prompt(en_statement_lines, intro_lines, solve_function_definition)
+
+    if translate:
+      Thread(target=propagate(report_translation), daemon=True,
+             args=(events, timeline, en_statement_lines)).start()
+
+    testdir = None
+    # Equivalent candidates are verified only once, and the count is kept across the rounds
+    clusters = {}
     all_candidates = []
-    candidates = []
-
-    logger.info(f'Generating function and fingerprints...')
-    for i, result in enumerate(results):
-      func = get_function(solve_function_definition, result)
-      fingerprint = get_fingerprint(func)
-      all_candidates.append(func)
-      if fingerprint not in fingerprints and len(func) < 800:
-        candidates.append((i, result))
-        fingerprints.add(fingerprint)
-
-    testdir = download_tests(contest_id, problem_id)
-
-    for choice, result in candidates:
-      outro = ''.join(outro_lines)
-      if 'print' not in result:
-        outro = re.sub(r'^(\s*)(solve\(.*\))$', r'\1print(\2)', outro, flags=re.M)
-      additional_libraries = ['math', 're', 'bisect', 'collections', 'heapq',
-                              'itertools', 'functools', 'fractions', 'numpy as np', 'numpy']
-      header = ''.join(map(lambda l: f'import {l}\n', additional_libraries))
-      code = header + notag_prompt + result + outro
-
-      execution_log = logger_io.getvalue()
-      exit_code = verify_code(code, execution_log, all_candidates, choice, testdir)
-      if exit_code != 0:
-        logger.info('Test didn\'t pass. Trying another candidate...')
-        continue
+    pending = []
+    rounds = 0
+    streams = 0
+    # The cache would serve the same candidates again, so it's read only once for each prompt
+    cached_prompts = set()
+    # Candidates passed the tests, which are submitted one by one until one of them is accepted
+    verified = []
+    judging = False
+    penalties = 0
+    # Consecutive rounds whose requests all failed
+    failures = 0
+    delays = backoff(initial=1, maximum=16, factor=2)
+
+    def start_completion(delay=0):
+      nonlocal cancel
+      # The event is set once a candidate passes, so the rounds after a rejection need a new one
+      if cancel.is_set():
+        cancel = Event()
+      cache_mode = completion_cache if prompt not in cached_prompts else 'off'
+      cached_prompts.add(prompt)
+      Thread(target=propagate(produce_candidates), daemon=True,
+             args=(events, cancel, timeline, notag_prompt, prompt, OPENAI_TOKEN, testcases,
+                   completion_endpoints, completion_parameter, split),
+             kwargs=dict(completion_cache=cache_mode, delay=delay)).start()
 
-      logger.info('Test passed. Submitting the code...')
+    while True:
+      # The next round starts while the candidates of the current round are still being verified,
+      # unless there are enough candidates left to verify. While a submission is being judged, the
+      # candidates left are verified but no more candidates are generated.
+      backlog = len(pending) + (0 if verifier is None else len(verifier.running))
+      if streams == 0 and not judging and len(verified) == 0 and backlog < testcases:
+        if failures >= MAX_COMPLETION_FAILURES:
+          # The candidates left are still verified, but no more requests are sent
+          if backlog == 0:
+            logger.error(f'Completion failed {failures} times in a row. Giving up.')
+            break
+        else:
+          delay = next(delays) if failures > 0 else 0
+          if failures > 0:
+            logger.info(f'Retrying completion in {delay} seconds...')
+          elif rounds > 0 and backlog == 0:
+            logger.info('Test didn\'t pass for any candidate. Retrying completion...')
+          elif rounds > 0:
+            logger.info(f'Starting the next completion with {backlog} candidates left to verify...')
+          rounds += 1
+          streams += 1
+          start_completion(delay)
+
+      kind, value = events.get()
+
+      if kind == 'tests':
+        testdir = tests_future.result()
+        if runner == 'warm':
+          preload_future.result()
+        # Samples are timed by the wall clock, so the workers running `jobs` samples each are
+        # kept within the cores given to this job, lest correct candidates get TLE
+        workers = max((cores or os.cpu_count() or 1) // jobs, 1)
+        verifier = Verifier(partial(verify_code, runner=runner, jobs=jobs), testdir, workers,
+                            timeline=timeline, on_done=lambda: events.put(('verified', None)))
+      elif kind == 'candidate':
+        result, finish_reason, candidate_prompt = value
+        func = get_function(solve_function_definition, result)
+        fingerprint = get_fingerprint(func)
+        all_candidates.append(func)
+        choice = len(all_candidates) - 1
+        if len(func) < 800:
+          if fingerprint not in clusters:
+            clusters[fingerprint] = 0
+            code = get_code(result, candidate_prompt, outro_lines)
+            severity, reason = check_code(code, finish_reason)
+            if severity != OK:
+              logger.info(f'Candidate {choice} failed the static check: {reason}')
+            # Broken candidates never pass the tests, so they are not even verified
+            if severity != BROKEN:
+              pending.append((fingerprint, severity, choice, code))
+          clusters[fingerprint] += 1
+      elif kind == 'completed':
+        streams -= 1
+        if value is None:
+          failures = 0
+          delays = backoff(initial=1, maximum=16, factor=2)
+        else:
+          failures += 1
+      elif kind == 'translated':
+        # The following rounds also use the translated statement
+        with timeline.stage('get_prompt', translated=True):
+          prompt, notag_prompt = get_prompt(value, intro_lines, solve_function_definition)
+        if not judging and len(verified) == 0:
+          logger.info('Starting the completion on the translated statement...')
+          streams += 1
+          start_completion()
+      elif kind == 'verdict':
+        choice, verdict = value
+        judging = False
+        if verdict == 'AC' or verdict is None:
+          break
+        if verdict not in UNPENALIZED_VERDICTS:
+          penalties += 1
+        if penalties > penalty_budget:
+          logger.warning(f'Penalty budget of {penalty_budget} is exhausted. Giving up.')
+          break
+        logger.info(f'Submitting the next candidate... (penalties: {penalties}/{penalty_budget})')
+
+      if verifier is None:
+        continue
 
-      while True:
-        execution_log = logger_io.getvalue()
-        exit_code = submit_code(code, execution_log, all_candidates, choice, contest_id, problem_id)
-        if exit_code == 0:
+      passed = verifier.poll()
+      while passed is not None:
+        # The candidates still being generated are not needed any more
+        cancel.set()
+        verified.append(passed)
+        passed = verifier.poll()
+
+
+      if not judging and len(verified) > 0:
+        choice, code = verified.pop(0)
+        logger.info(f'Test passed for candidate {choice}. Submitting the code...')
+        submission_id = submit_with_retries(timeline, code, all_candidates, choice, contest_id,
+                                            problem_id)
+        # Without the penalty budget, the job ends with the first submission
+        if penalty_budget == 0:
           break
-        logger.info('Submission failed. Trying after 0.5s...')
-        sleep(0.5)
-      logger.info('Submission succeeded.')
-      testdir.cleanup()
-      return 0
+        judging = True
+        Thread(target=propagate(report_verdict), daemon=True,
+               args=(events, timeline, contest_id, choice, submission_id)).start()
+
+      # Candidates wait for an idle worker, so that the largest cluster passing the static check
+      # goes first
+      while len(pending) > 0 and verifier.count_idle() > 0:
+        candidate = max(pending, key=lambda candidate: (-candidate[1], clusters[candidate[0]]))
+        pending.remove(candidate)
+        _, _, choice, code = candidate
+        # The submission is verified with the candidates generated until this one
+        verifier.add(choice, code, get_execution_log().snapshot(),
+                     get_candidates_summary(all_candidates, choice + 1))
+
+  finally:
+    # Outstanding completion requests are closed as soon as they notice. The workers and the
+    # threads are stopped also when the job fails, which would leak them in the daemon.
+    cancel.set()
+    if verifier is not None:
+      verifier.close()
+    # The download may still be retrying when the job fails, which is not worth waiting for
+    executor.shutdown(wait=False, cancel_futures=True)
+
+  log_clusters(clusters)
+  timeline.log()
+  if trace_dir is not None:
+    timeline.export(trace_dir)
+  return 0
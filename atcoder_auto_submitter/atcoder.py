@@ -12,16 +12,63 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
 from pathlib import Path
+from time import sleep, perf_counter
+from threading import Lock
 from tempfile import TemporaryDirectory
-from bs4 import BeautifulSoup
-from atcodertools.tools.envgen import main as envgen_main
+from lxml import etree, html as lxml_html
+from atcodertools.client.atcoder import AtCoderClient, LoginError, PageNotFoundError
+from atcodertools.client.models.contest import Contest
+from atcodertools.client.models.problem import Problem
+from atcodertools.client.models.problem_content import InputFormatDetectionError, \
+    SampleDetectionError
+from atcodertools.codegen.code_style_config import CodeStyleConfig
+from atcodertools.codegen.models.code_gen_args import CodeGenArgs
+from atcodertools.constprediction.constants_prediction import predict_constants
+from atcodertools.fmtprediction.models.format_prediction_result import FormatPredictionResult
+from atcodertools.fmtprediction.predict_format import NoPredictionResultError, \
+    MultiplePredictionResultsError, predict_format
 from atcodertools.common.logging import logger
-from googletrans import Translator
+from atcoder_auto_submitter.session import ATCODER_URL, get_session
+from atcoder_auto_submitter.scheduler import backoff
+from atcoder_auto_submitter.timeline import Timeline
+from atcoder_auto_submitter.cache import get_translation_digest, load_translation, store_translation
 
-translator = Translator()
+translator = None
 dirname = Path(__file__).parent
 
+logged_in = False
+login_lock = Lock()
+
+LATEX_COMMANDS = {
+    'neq': '!=',
+    'ne': '!=',
+    ',': ' ',
+    'times': 'x',
+    'leqq': '<=',
+    'leq': '<=',
+    'le': '<=',
+    'lt': '<',
+    'geqq': '>=',
+    'geq': '>=',
+    'ge': '>=',
+    'gt': '>',
+    'dots': '...',
+    'cdots': '...',
+    'ldots': '...',
+    'mathrm': '',
+}
+
+# The whole name of a command is matched at once, so that \leq is not read as \le followed by q,
+# and unknown commands such as \left are kept as they are
+LATEX_PATTERN = re.compile(r'\\([a-zA-Z]+|,)|\^')
+
+STATEMENT_XPATH = etree.XPath(
+    '//span[contains(concat(" ", normalize-space(@class), " "), concat(" lang-", $language, " "))]')
+SECTION_XPATH = etree.XPath('.//div[contains(concat(" ", normalize-space(@class), " "), " part ")]')
+STATEMENT_TAGS_XPATH = etree.XPath('.//*[self::p or self::ul or self::ol]')
+
 def flatmap(f, xs):
   ys = []
   for x in xs:
@@ -36,7 +83,96 @@ def find_index(f, xs):
   return -1
 
 
-def get_template(contest, problem_id, language='en', translate=False):
+def get_translator():
+  global translator
+  if translator is None:
+    # googletrans is imported only when the translation is requested
+    from googletrans import Translator
+    translator = Translator()
+  return translator
+
+
+def login():
+  global logged_in
+  with login_lock:
+    if logged_in:
+      return
+
+    # Mounts the connection pool before the first request of atcoder-tools
+    get_session(ATCODER_URL)
+    try:
+      AtCoderClient().login()
+      logged_in = True
+    except LoginError as e:
+      logger.warning(f'Login to AtCoder failed: {e}')
+
+
+def check_login():
+  global logged_in
+  with login_lock:
+    if logged_in and not AtCoderClient().check_logging_in():
+      logger.warning('AtCoder session has expired. Logging in again...')
+      logged_in = False
+
+  login()
+  return logged_in
+
+
+def get_problem_ids(contest):
+  login()
+
+  for delay in backoff():
+    try:
+      problems = AtCoderClient().download_problem_list(Contest(contest))
+      break
+    except PageNotFoundError:
+      logger.info(f'Problem list extraction failed. Trying after {delay:.2f}s...')
+      sleep(delay)
+
+  return [problem.problem_id.rsplit('_', 1)[-1] for problem in problems]
+
+
+def get_problem(contest, problem_id, timeline=None):
+  timeline = timeline or Timeline(f'{contest}_{problem_id}')
+  logger.info('Fetching the problem with atcoder-tools...')
+
+  login()
+  problem = Problem(Contest(contest), problem_id.upper(), f'{contest}_{problem_id}')
+
+  with timeline.stage('scrape') as stage:
+    for attempt, delay in enumerate(backoff()):
+      try:
+        content = AtCoderClient().download_problem_content(problem)
+        break
+      except (InputFormatDetectionError, SampleDetectionError):
+        # The task page may not be available yet right after the beginning of the contest
+        if attempt == 59:
+          raise
+        logger.info(f'Problem extraction failed. Trying after {delay:.2f}s...')
+        sleep(delay)
+    stage['attempts'] = attempt + 1
+
+  with timeline.stage('codegen'):
+    constants = predict_constants(content.original_html)
+    try:
+      prediction_result = predict_format(content)
+    except (NoPredictionResultError, MultiplePredictionResultsError):
+      logger.warning('Failed to understand the input format')
+      prediction_result = FormatPredictionResult.empty_result()
+
+    config = CodeStyleConfig(lang='python')
+    with open(config.template_file) as f:
+      template = f.read()
+    code = config.code_generator(CodeGenArgs(template, prediction_result.format, constants, config))
+
+  logger.info('Generated code with atcoder-tools.')
+
+  return content.original_html, code.splitlines(keepends=True)
+
+
+def get_problem_with_envgen(contest, problem_id):
+  from atcodertools.tools.envgen import main as envgen_main
+
   logger.info('Invoking atcoder-tools...')
 
   problem_index = ord(problem_id) - ord('a')
@@ -48,57 +184,37 @@ def get_template(contest, problem_id, language='en', translate=False):
       problem_index
   )
 
-  problem_a_html = res[0].original_html
-  soup = BeautifulSoup(problem_a_html, features="lxml")
-  en_descriptions = soup.find("span", {"class": f'lang-{language}'})
-  if en_descriptions is None:
-    raise Exception(f'Statement with language = {language} not found')
-  en_sections = en_descriptions.findAll("div", {"class": "part"})
-  en_statement = en_sections[0]
+  template_path = Path(workspace_dir.name, contest, chr(ord('A') + problem_index), 'main.py')
+  with template_path.open() as f:
+    template_lines = list(f)
 
-  en_output_section = None
-  for section in en_sections:
-    h3 = section.find('h3')
-    if h3 and h3.get_text() == 'Output':
-      en_output_section = section
+  logger.info('Read generated code from atcoder-tools.')
+  workspace_dir.cleanup()
 
-  en_statement_tags = en_statement.findAll(['p', 'ul', 'ol'])
+  return res[0].original_html, template_lines
 
-  en_statement_lines = []
-  for tag in en_statement_tags:
-    if tag.name == 'p':
-      en_statement_lines.extend(tag.get_text().split('\r\n'))
-    else:
-      li_elements = tag.findAll('li')
-      if tag.name == 'ul':
-        en_statement_lines.extend(map(lambda el: f'* {el.get_text()}', li_elements))
-      elif tag.name == 'ol':
-        en_statement_lines.extend(map(
-            lambda d: f'{d[0] + 1}. {d[1].get_text()}',
-            enumerate(li_elements)
-        ))
-
-  if en_output_section is not None:
-    codes = en_output_section.find('code')
-    if codes is not None or '-1' in en_output_section.get_text():
-      en_output_section_tags = en_output_section.findAll('p')
-      for tag in en_output_section_tags:
-        en_statement_lines.extend(tag.get_text().split('\r\n'))
 
-  logger.info(f'Problem statement extracted: {en_statement_lines}')
+def get_template(contest, problem_id, language='en', translate=False, fast_template=True,
+                 timeline=None):
+  timeline = timeline or Timeline(f'{contest}_{problem_id}')
+  with timeline.stage('get_template', fast_template=fast_template):
+    return extract_template(contest, problem_id, language, translate, fast_template, timeline)
 
-  if translate:
-    logger.info(f'Translating statement...')
-    translation_result = translator.translate('\n'.join(en_statement_lines))
-    logger.info(f'Translation succeeded: {translation_result.text.splitlines()}')
-    en_statement_lines = translation_result.text.splitlines()
 
-  template_path = Path(workspace_dir.name, contest, chr(ord('A') + problem_index), 'main.py')
-  with template_path.open() as f:
-    template_lines = list(f)
+def extract_template(contest, problem_id, language, translate, fast_template, timeline):
+  if fast_template:
+    problem_a_html, template_lines = get_problem(contest, problem_id, timeline)
+  else:
+    problem_a_html, template_lines = timeline.run('envgen', get_problem_with_envgen,
+                                                  contest, problem_id)
 
-  logger.info('Read generated code from atcoder-tools.')
-  workspace_dir.cleanup()
+  extract_started_at = perf_counter()
+  en_statement_lines = extract_statement(problem_a_html, language)
+  logger.info(f'Problem statement extracted: {en_statement_lines}')
+  timeline.add('extract_statement', extract_started_at, perf_counter())
+
+  if translate:
+    en_statement_lines = translate_statement(en_statement_lines, timeline)
 
   # Strips shebang
   template_lines = template_lines[1:]
@@ -114,23 +230,69 @@ def get_template(contest, problem_id, language='en', translate=False):
   return en_statement_lines, intro_lines, solve_function_definition, outro_lines
 
 
+def extract_statement(problem_html, language):
+  # The page is parsed once, and only the statement span is walked with precompiled XPaths
+  descriptions = STATEMENT_XPATH(lxml_html.fromstring(problem_html), language=language)
+  if len(descriptions) == 0:
+    raise Exception(f'Statement with language = {language} not found')
+  sections = SECTION_XPATH(descriptions[0])
+  statement = sections[0]
+
+  output_section = None
+  for section in sections:
+    h3 = section.find('.//h3')
+    if h3 is not None and h3.text_content() == 'Output':
+      output_section = section
+
+  statement_lines = []
+  for tag in STATEMENT_TAGS_XPATH(statement):
+    if tag.tag == 'p':
+      statement_lines.extend(tag.text_content().split('\r\n'))
+    elif tag.tag == 'ul':
+      statement_lines.extend(f'* {li.text_content()}' for li in tag.iterdescendants('li'))
+    else:
+      statement_lines.extend(f'{i + 1}. {li.text_content()}'
+                             for i, li in enumerate(tag.iterdescendants('li')))
+
+  if output_section is not None:
+    if output_section.find('.//code') is not None or '-1' in output_section.text_content():
+      for tag in output_section.iterdescendants('p'):
+        statement_lines.extend(tag.text_content().split('\r\n'))
+
+  return statement_lines
+
+
+def translate_statement(statement_lines, timeline=None):
+  timeline = timeline or Timeline('translate')
+  digest = get_translation_digest(statement_lines)
+
+  with timeline.stage('translate') as stage:
+    translated_lines = load_translation(digest)
+    stage['cached'] = translated_lines is not None
+    if translated_lines is not None:
+      logger.info(f'Using the cached translation: {translated_lines}')
+      return translated_lines
+
+    logger.info(f'Translating statement...')
+    translation_result = get_translator().translate('\n'.join(statement_lines))
+    translated_lines = translation_result.text.splitlines()
+
+  logger.info(f'Translation succeeded: {translated_lines}')
+  store_translation(digest, translated_lines)
+  return translated_lines
+
+
+def replace_latex(match):
+  if match[1] is None:
+    return ' ** '
+  return LATEX_COMMANDS.get(match[1], match[0])
+
+
 def normalize_statement_line(line):
-  return line \
-      .replace('\\neq', '!=') \
-      .replace('\\,', ' ') \
-      .replace('\\times', 'x') \
-      .replace('\\leq', '<=') \
-      .replace('\\le', '<=') \
-      .replace('\\lt', '<') \
-      .replace('\\geq', '>=') \
-      .replace('\\ge', '>=') \
-      .replace('\\gt', '>') \
-      .replace('\\dots', '...') \
-      .replace('\\cdots', '...') \
-      .replace('\\ldots', '...') \
-      .replace('^', ' ** ') \
-      .replace('\\mathrm', '') \
-      .strip()
+  # Lines of prose have nothing to replace, which is cheaper to tell than to scan with the pattern
+  if '\\' not in line and '^' not in line:
+    return line.strip()
+  return LATEX_PATTERN.sub(replace_latex, line).strip()
 
 
 def get_prompt(en_statement_lines, intro_lines, solve_function_definition):
@@ -0,0 +1,211 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from time import time
+from tempfile import mkdtemp, mkstemp
+from atcodertools.common.logging import logger
+
+CACHE_DIR = Path(os.getenv('ATCODER_AUTO_SUBMITTER_CACHE_DIR',
+                           Path.home() / '.cache/atcoder-auto-submitter'))
+
+TESTS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TESTS_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+COMPLETIONS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+TRANSLATIONS_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+# Verdicts and runtime of each sample, which decide the order of the samples
+SAMPLE_STATS_FILE = '.stats.json'
+
+
+def get_cache_dir(*names):
+  path = CACHE_DIR.joinpath(*names)
+  path.mkdir(parents=True, exist_ok=True)
+  return path
+
+
+def get_size(path):
+  if path.is_file():
+    return path.stat().st_size
+  return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def remove(path):
+  if path.is_dir():
+    shutil.rmtree(path, ignore_errors=True)
+  else:
+    path.unlink(missing_ok=True)
+
+
+def touch(path):
+  try:
+    os.utime(path)
+  except FileNotFoundError:
+    pass
+
+
+def evict(directory, max_bytes=None, max_age=None):
+  # Entries are touched when used, so mtime works as the LRU order
+  entries = []
+  for path in directory.iterdir():
+    if path.name.startswith('.'):
+      continue
+    try:
+      entries.append((path.stat().st_mtime, get_size(path), path))
+    except FileNotFoundError:
+      continue
+  entries.sort()
+
+  now = time()
+  total = sum(size for _, size, _ in entries)
+  for mtime, size, path in entries:
+    expired = max_age is not None and now - mtime > max_age
+    oversized = max_bytes is not None and total > max_bytes
+    if not expired and not oversized:
+      break
+    logger.info(f'Evicting cache entry {path}')
+    remove(path)
+    total -= size
+
+
+def get_tests_digest(testdir):
+  digest = hashlib.sha256()
+  for path in sorted(Path(testdir).iterdir()):
+    digest.update(path.name.encode() + b'\0')
+    digest.update(hashlib.sha256(path.read_bytes()).digest())
+  return digest.hexdigest()
+
+
+def load_tests(contest, problem_id):
+  ref = get_cache_dir('tests', 'refs') / f'{contest}_{problem_id}'
+  if not ref.exists():
+    return None
+
+  testdir = get_cache_dir('tests', 'objects') / ref.read_text().strip()
+  if not testdir.is_dir():
+    ref.unlink(missing_ok=True)
+    return None
+
+  # Refs are evicted by age as well, so a problem used every day keeps its ref
+  touch(ref)
+  touch(testdir)
+  return testdir
+
+
+def create_tests_dir():
+  # Created inside the cache so that store_tests can publish it with an atomic rename
+  return Path(mkdtemp(prefix='.', dir=get_cache_dir('tests', 'objects')))
+
+
+def store_tests(contest, problem_id, testdir):
+  objects_dir = get_cache_dir('tests', 'objects')
+  refs_dir = get_cache_dir('tests', 'refs')
+
+  digest = get_tests_digest(testdir)
+  target = objects_dir / digest
+  try:
+    os.rename(testdir, target)
+  except OSError:
+    # The same test cases are already stored
+    remove(Path(testdir))
+    touch(target)
+
+  ref_tmp = refs_dir / f'.{contest}_{problem_id}.{os.getpid()}'
+  ref_tmp.write_text(digest)
+  os.replace(ref_tmp, refs_dir / f'{contest}_{problem_id}')
+
+  evict(objects_dir, max_bytes=TESTS_CACHE_MAX_BYTES, max_age=TESTS_CACHE_MAX_AGE)
+  evict(refs_dir, max_age=TESTS_CACHE_MAX_AGE)
+  return target
+
+
+def get_completions_digest(prompt, n, completion_endpoint, completion_parameter):
+  key = json.dumps([prompt, n, completion_endpoint, completion_parameter], sort_keys=True)
+  return hashlib.sha256(key.encode()).hexdigest()
+
+
+def load_completions(digest):
+  path = get_cache_dir('completions') / f'{digest}.json'
+  try:
+    completions = json.loads(path.read_text())
+  except (FileNotFoundError, ValueError):
+    return None
+
+  touch(path)
+  return [tuple(completion) for completion in completions]
+
+
+def store_completions(digest, completions):
+  completions_dir = get_cache_dir('completions')
+
+  fd, tmp = mkstemp(prefix='.', dir=completions_dir)
+  with os.fdopen(fd, 'w') as f:
+    json.dump(completions, f)
+  os.replace(tmp, completions_dir / f'{digest}.json')
+
+  evict(completions_dir, max_bytes=COMPLETIONS_CACHE_MAX_BYTES)
+
+
+def load_sample_stats(testdir):
+  try:
+    return json.loads((Path(testdir) / SAMPLE_STATS_FILE).read_text())
+  except (FileNotFoundError, ValueError):
+    return {}
+
+
+def update_sample_stats(testdir, samples):
+  # Kept next to the test cases, so that the stats are evicted together with them
+  stats = load_sample_stats(testdir)
+  for sample in samples:
+    stat = stats.setdefault(sample['name'], dict(runs=0, failures=0, elapsed=0.0))
+    stat['runs'] += 1
+    if sample['verdict'] != 'AC':
+      stat['failures'] += 1
+    stat['elapsed'] += (sample['elapsed'] - stat['elapsed']) / stat['runs']
+
+  fd, tmp = mkstemp(prefix='.', dir=testdir)
+  with os.fdopen(fd, 'w') as f:
+    json.dump(stats, f)
+  os.replace(tmp, Path(testdir) / SAMPLE_STATS_FILE)
+
+
+def get_translation_digest(statement_lines):
+  return hashlib.sha256('\n'.join(statement_lines).encode()).hexdigest()
+
+
+def load_translation(digest):
+  path = get_cache_dir('translations') / f'{digest}.json'
+  try:
+    translation = json.loads(path.read_text())
+  except (FileNotFoundError, ValueError):
+    return None
+
+  touch(path)
+  return translation
+
+
+def store_translation(digest, translation):
+  translations_dir = get_cache_dir('translations')
+
+  fd, tmp = mkstemp(prefix='.', dir=translations_dir)
+  with os.fdopen(fd, 'w') as f:
+    json.dump(translation, f)
+  os.replace(tmp, translations_dir / f'{digest}.json')
+
+  evict(translations_dir, max_bytes=TRANSLATIONS_CACHE_MAX_BYTES)
@@ -0,0 +1,104 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+import builtins
+import symtable
+
+# Severity of the problems found by check_code
+OK = 0
+SUSPICIOUS = 1
+BROKEN = 2
+
+BUILTIN_NAMES = set(dir(builtins))
+
+
+def get_defined_names(table):
+  names = set()
+  for symbol in table.get_symbols():
+    if symbol.is_assigned() or symbol.is_imported():
+      names.add(symbol.get_name())
+
+  # Globals assigned inside functions with `global` statement
+  tables = list(table.get_children())
+  while len(tables) > 0:
+    child = tables.pop()
+    tables.extend(child.get_children())
+    for symbol in child.get_symbols():
+      if symbol.is_declared_global() and symbol.is_assigned():
+        names.add(symbol.get_name())
+
+  return names
+
+
+def get_undefined_names(table, defined_names):
+  names = []
+  tables = [table]
+  while len(tables) > 0:
+    child = tables.pop()
+    tables.extend(child.get_children())
+    for symbol in child.get_symbols():
+      name = symbol.get_name()
+      if symbol.is_referenced() and symbol.is_global() and \
+         name not in defined_names and name not in BUILTIN_NAMES:
+        names.append(name)
+  return names
+
+
+def has_output(function):
+  for node in ast.walk(function):
+    if isinstance(node, ast.Return) and node.value is not None:
+      return True
+    if isinstance(node, ast.Call):
+      func = node.func
+      if isinstance(func, ast.Name) and func.id in ('print', 'exit'):
+        return True
+      if isinstance(func, ast.Attribute) and func.attr in ('write', 'exit'):
+        return True
+  return False
+
+
+def check_code(code, finish_reason=None):
+  # Runs in-process in well under a millisecond, to keep broken candidates away from the runner
+  if finish_reason == 'length':
+    return BROKEN, 'truncated by max_tokens'
+
+  try:
+    tree = ast.parse(code)
+    # Compiling also rejects the code the parser accepts, such as `break` outside a loop or
+    # a parameter declared global
+    compile(tree, '<candidate>', 'exec')
+    table = symtable.symtable(code, '<candidate>', 'exec')
+  except SyntaxError as e:
+    return BROKEN, f'syntax error at line {e.lineno}: {e.msg}'
+  except ValueError as e:
+    # Null bytes in the code
+    return BROKEN, str(e)
+
+  solve = next((node for node in tree.body
+                if isinstance(node, ast.FunctionDef) and node.name == 'solve'), None)
+  if solve is None:
+    return BROKEN, 'solve function not found'
+
+  if not has_output(solve):
+    return SUSPICIOUS, 'no return value or output'
+
+  # Names imported with wildcard can't be resolved statically
+  if not any(isinstance(node, ast.ImportFrom) and node.names[0].name == '*' for node in tree.body):
+    solve_table = next(child for child in table.get_children() if child.get_name() == 'solve')
+    undefined_names = get_undefined_names(solve_table, get_defined_names(table))
+    if len(undefined_names) > 0:
+      return SUSPICIOUS, f'undefined names: {", ".join(sorted(set(undefined_names)))}'
+
+  return OK, None
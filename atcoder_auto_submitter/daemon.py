@@ -0,0 +1,120 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import stat
+import socket
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from atcodertools.common.logging import logger
+
+
+def parse_address(address):
+  # [HOST:]PORT for HTTP over TCP, otherwise a path of UNIX socket
+  host, _, port = address.rpartition(':')
+  if port.isdigit():
+    return host or '127.0.0.1', int(port)
+  return address
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+  daemon_threads = True
+
+
+class UnixHTTPConnection(HTTPConnection):
+  def __init__(self, socket_path, timeout=None):
+    super().__init__('localhost', timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.socket_path)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+  def do_POST(self):
+    if self.path != '/jobs':
+      self.send_error(404)
+      return
+
+    length = int(self.headers.get('Content-Length', 0))
+    try:
+      request = json.loads(self.rfile.read(length))
+    except ValueError as e:
+      self.send_json(400, {'status': 'invalid', 'error': str(e)})
+      return
+
+    logger.info(f'Accepted job: {request}')
+    try:
+      self.server.run_job(request)
+      self.send_json(200, {'status': 'finished'})
+    except Exception as e:
+      logger.error(f'Job failed: {e}')
+      self.send_json(500, {'status': 'failed', 'error': str(e)})
+
+  def send_json(self, code, body):
+    data = json.dumps(body).encode()
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def address_string(self):
+    # The client address of UNIX socket is an empty string
+    if isinstance(self.client_address, tuple):
+      return self.client_address[0]
+    return 'unix'
+
+  def log_message(self, format, *args):
+    logger.info(f'{self.address_string()} - {format % args}')
+
+
+def serve(address, run_job):
+  address = parse_address(address)
+
+  if isinstance(address, str):
+    # Removes the socket left by the previous daemon, but nothing else
+    if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+      os.unlink(address)
+    server = UnixHTTPServer(address, JobHandler)
+  else:
+    server = ThreadingHTTPServer(address, JobHandler)
+  server.run_job = run_job
+
+  logger.info(f'Listening for jobs on {address}')
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    if isinstance(address, str):
+      os.unlink(address)
+
+
+def submit_job(address, request):
+  address = parse_address(address)
+
+  if isinstance(address, str):
+    conn = UnixHTTPConnection(address)
+  else:
+    conn = HTTPConnection(*address)
+
+  try:
+    conn.request('POST', '/jobs', body=json.dumps(request),
+                 headers={'Content-Type': 'application/json'})
+    return json.loads(conn.getresponse().read())
+  finally:
+    conn.close()
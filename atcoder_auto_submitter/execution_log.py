@@ -0,0 +1,124 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from threading import Lock
+from weakref import WeakSet
+from atcodertools.common.logging import logger, logger_io, formatter
+
+# Records kept per job, and the size of the log embedded into a submission
+MAX_RECORDS = 1000
+MAX_LOG_SIZE = 64 * 1024
+
+# The log is embedded into a string literal quoted with ''', which must not be closed by the log
+QUOTES = re.compile(r"'+")
+
+# Logs alive in this process, whose locks are renewed in a forked child
+execution_logs = WeakSet()
+
+
+class ExecutionLog:
+  def __init__(self, name, max_records=MAX_RECORDS):
+    self.name = name
+    self.records = deque(maxlen=max_records)
+    self.dropped = 0
+    self.lock = Lock()
+    execution_logs.add(self)
+
+  def append(self, line):
+    with self.lock:
+      if len(self.records) == self.records.maxlen:
+        self.dropped += 1
+      self.records.append(line)
+
+  def snapshot(self, max_size=MAX_LOG_SIZE):
+    # The latest records fitting in max_size, so that a long job doesn't bloat the submission
+    with self.lock:
+      omitted = self.dropped
+      lines = []
+      size = 0
+      for line in reversed(self.records):
+        size += len(line) + 1
+        if size > max_size:
+          omitted += len(self.records) - len(lines)
+          break
+        lines.append(line)
+
+    lines.reverse()
+    if omitted > 0:
+      lines.insert(0, f'({omitted} earlier records omitted)')
+    return lines
+
+
+# Records logged outside of any job, which are also bounded
+default_log = ExecutionLog('default')
+current_log = ContextVar('current_log', default=default_log)
+
+
+class ExecutionLogHandler(logging.Handler):
+  def emit(self, record):
+    try:
+      line = QUOTES.sub("'", self.format(record))
+    except Exception:
+      self.handleError(record)
+      return
+    current_log.get().append(line)
+
+
+def reset_locks():
+  # Verification workers are forked while the threads of the jobs are logging. A lock held by one
+  # of them at the fork would never be released in the child, which hangs at its first record.
+  for execution_log in list(execution_logs):
+    execution_log.lock = Lock()
+
+
+def get_execution_log():
+  return current_log.get()
+
+
+@contextmanager
+def log_scope(execution_log):
+  token = current_log.set(execution_log)
+  try:
+    yield execution_log
+  finally:
+    current_log.reset(token)
+
+
+def run_in_scope(execution_log, f, *args, **kwargs):
+  with log_scope(execution_log):
+    return f(*args, **kwargs)
+
+
+def propagate(f):
+  # Threads start with an empty context, so each of them gets a copy of the caller's context
+  return partial(copy_context().run, f)
+
+
+os.register_at_fork(after_in_child=reset_locks)
+
+handler = ExecutionLogHandler()
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# logger_io of atcoder-tools keeps every record of the process, which never shrinks in the daemon
+for io_handler in list(logger.handlers):
+  if isinstance(io_handler, logging.StreamHandler) and io_handler.stream is logger_io:
+    logger.removeHandler(io_handler)
@@ -0,0 +1,157 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import ast
+
+INVERTED_OPERATORS = {
+    ast.Eq: ast.NotEq,
+    ast.NotEq: ast.Eq,
+    ast.In: ast.NotIn,
+    ast.NotIn: ast.In,
+    ast.Is: ast.IsNot,
+    ast.IsNot: ast.Is,
+}
+
+FLIPPED_OPERATORS = {
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+}
+
+
+def get_bound_names(tree):
+  names = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+      names.add(node.id)
+    elif isinstance(node, ast.arg):
+      names.add(node.arg)
+    elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+      names.add(node.name)
+    elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node is not tree.body[0]:
+      names.add(node.name)
+  return names
+
+
+class Normalizer(ast.NodeTransformer):
+  def __init__(self, bound_names):
+    self.bound_names = bound_names
+    self.names = {}
+
+  def rename(self, name):
+    # Locals are renamed in the order of appearance, and globals such as builtins are kept
+    if name not in self.bound_names:
+      return name
+    if name not in self.names:
+      self.names[name] = f'_{len(self.names)}'
+    return self.names[name]
+
+  def visit_Name(self, node):
+    node.id = self.rename(node.id)
+    return node
+
+  def visit_arg(self, node):
+    node.arg = self.rename(node.arg)
+    node.annotation = None
+    return node
+
+  def visit_FunctionDef(self, node):
+    if node.name != 'solve':
+      node.name = self.rename(node.name)
+    node.returns = None
+    return self.generic_visit(node)
+
+  def visit_ExceptHandler(self, node):
+    if node.name is not None:
+      node.name = self.rename(node.name)
+    return self.generic_visit(node)
+
+  def generic_visit(self, node):
+    node = super().generic_visit(node)
+    for field in ('body', 'orelse', 'finalbody'):
+      statements = getattr(node, field, None)
+      if isinstance(statements, list):
+        setattr(node, field, self.strip_body(statements))
+    return node
+
+  @staticmethod
+  def strip_body(body):
+    # Docstrings, bare string literals and `pass` don't change the behavior
+    stripped = [
+        statement for statement in body
+        if not isinstance(statement, ast.Pass) and
+        not (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant) and
+             isinstance(statement.value.value, str))
+    ]
+    if len(stripped) == 0 and len(body) > 0:
+      return [ast.Pass()]
+    return stripped
+
+  def visit_Compare(self, node):
+    self.generic_visit(node)
+    if len(node.ops) != 1:
+      return node
+    op = type(node.ops[0])
+    if op in FLIPPED_OPERATORS:
+      # a > b is the same as b < a
+      return ast.Compare(left=node.comparators[0], ops=[FLIPPED_OPERATORS[op]()],
+                         comparators=[node.left])
+    if op in (ast.Eq, ast.NotEq) and ast.dump(node.comparators[0]) < ast.dump(node.left):
+      return ast.Compare(left=node.comparators[0], ops=node.ops, comparators=[node.left])
+    return node
+
+  def visit_UnaryOp(self, node):
+    self.generic_visit(node)
+    # not a == b is the same as a != b
+    if isinstance(node.op, ast.Not) and isinstance(node.operand, ast.Compare) and \
+       len(node.operand.ops) == 1 and type(node.operand.ops[0]) in INVERTED_OPERATORS:
+      compare = node.operand
+      inverted = ast.Compare(left=compare.left,
+                             ops=[INVERTED_OPERATORS[type(compare.ops[0])]()],
+                             comparators=compare.comparators)
+      return self.visit_Compare(inverted)
+    return node
+
+  def visit_Call(self, node):
+    self.generic_visit(node)
+    # range(0, n) is the same as range(n)
+    if isinstance(node.func, ast.Name) and node.func.id == 'range' and len(node.args) == 2 and \
+       isinstance(node.args[0], ast.Constant) and node.args[0].value == 0 and \
+       len(node.keywords) == 0:
+      node.args = node.args[1:]
+    return node
+
+  def visit_Return(self, node):
+    self.generic_visit(node)
+    if isinstance(node.value, ast.Constant) and node.value.value is None:
+      node.value = None
+    return node
+
+
+def get_regex_fingerprint(func):
+  func = re.sub(r'#.+$', '', func, flags=re.M)
+  func = re.sub(r'[\s()]', '', func)
+  return func
+
+
+def get_fingerprint(func):
+  try:
+    tree = ast.parse(func)
+  except SyntaxError:
+    # Truncated candidates can't be parsed, and are only compared textually
+    return get_regex_fingerprint(func)
+
+  tree = Normalizer(get_bound_names(tree)).visit(tree)
+  # unparse also canonicalizes the quotes, the parentheses and the notation of numbers
+  return ast.unparse(ast.fix_missing_locations(tree))
@@ -0,0 +1,75 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from time import sleep, monotonic
+import requests
+from atcodertools.common.logging import logger
+from atcoder_auto_submitter.session import ATCODER_URL, get_session
+from atcoder_auto_submitter.scheduler import backoff
+
+VERDICTS = {'AC', 'WA', 'TLE', 'MLE', 'RE', 'CE', 'OLE', 'IE', 'QLE'}
+
+# Compilation errors are not counted as penalties by AtCoder
+UNPENALIZED_VERDICTS = {'AC', 'CE', 'IE'}
+
+TAG = re.compile(r'<[^>]+>')
+
+JUDGE_TIMEOUT = 600
+
+
+def get_status_url(contest, submission_id):
+  # Same endpoint as the one polled by the submission list of AtCoder, which suggests the interval
+  return (f'{ATCODER_URL}contests/{contest}/submissions/me/status/json'
+          f'?reload=true&sids[]={submission_id}')
+
+
+def parse_verdict(html):
+  # The label is e.g. `WJ`, `3/12` while judging, `3/12 WA` once a case failed, and `AC` at the end
+  tokens = TAG.sub(' ', html).split()
+  verdicts = [token for token in tokens if token in VERDICTS]
+  if len(verdicts) == 0:
+    return None
+  # A failed case is final, since the rest of the cases can't turn it into AC
+  if verdicts[-1] == 'AC' and any('/' in token for token in tokens):
+    return None
+  return verdicts[-1]
+
+
+def wait_for_verdict(contest, submission_id, timeout=JUDGE_TIMEOUT):
+  session = get_session(ATCODER_URL)
+  url = get_status_url(contest, submission_id)
+  delays = backoff(initial=0.5, maximum=3)
+  deadline = monotonic() + timeout
+
+  while monotonic() < deadline:
+    delay = next(delays)
+    try:
+      res = session.get(url, timeout=5)
+      res.raise_for_status()
+      status = res.json()
+      result = status.get('Result', {}).get(str(submission_id))
+      if result is not None:
+        verdict = parse_verdict(result['Html'])
+        if verdict is not None:
+          return verdict
+      # The interval suggested by the server is in milliseconds
+      if status.get('Interval') is not None:
+        delay = status['Interval'] / 1000
+    except (requests.RequestException, ValueError, KeyError) as e:
+      logger.info(f'Failed to get the status of submission {submission_id}: {e!r}')
+    sleep(delay)
+
+  logger.warning(f'Gave up waiting for the verdict of submission {submission_id}.')
+  return None
@@ -12,28 +12,197 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import argparse
 import sys
-from atcoder_auto_submitter.app import run_without_test, run_with_test
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from atcoder_auto_submitter.scheduler import parse_run_at, get_clock_offset, wait_until
+from atcoder_auto_submitter.daemon import serve, submit_job
+from atcoder_auto_submitter.timeline import Timeline
+from atcoder_auto_submitter.execution_log import ExecutionLog, log_scope, run_in_scope
 from atcodertools.common.logging import logger
-import schedule
-from time import sleep
 
 DEFAULT_COMPLETION_API_ENDPOINT = 'https://api.openai.com/v1/engines/davinci-codex/completions'
 
+# Close enough to the start that the warmed connections are still kept alive
+PREWARM_SECONDS = 5
+
+CONTEST_OPTIONS = ['problems', 'priority', 'workers']
+
+# The heavy modules are imported in the functions below, so that a client of the daemon and
+# the jobs not using them never pay for the import
+
 
 def job(
-        problem_id, contest_id, testcases, completion_endpoint, completion_parameter, language,
-        translate, test):
-  if test:
-    run_with_test(problem_id, contest_id, testcases=testcases,
-                  completion_endpoint=completion_endpoint,
-                  completion_parameter=completion_parameter, language=language, translate=translate)
+        problem_id, contest_id, testcases, completion_endpoints, completion_parameter, language,
+        translate, test, runner='oj', fast_template=True, template=None, split=1,
+        completion_cache='off', timeline=None, trace_dir=None, execution_log=None,
+        penalty_budget=0, jobs=1, cores=None):
+  from atcoder_auto_submitter.app import run_without_test, run_with_test
+
+  # Records logged by the job and the threads started by it go to the log of this job only
+  execution_log = execution_log or ExecutionLog(f'{contest_id}_{problem_id}')
+  with log_scope(execution_log):
+    if test:
+      run_with_test(problem_id, contest_id, testcases=testcases,
+                    completion_endpoints=completion_endpoints,
+                    completion_parameter=completion_parameter, language=language,
+                    translate=translate, runner=runner, fast_template=fast_template,
+                    template=template, split=split, completion_cache=completion_cache,
+                    timeline=timeline, trace_dir=trace_dir, penalty_budget=penalty_budget,
+                    jobs=jobs, cores=cores)
+    else:
+      run_without_test(problem_id, contest_id, testcases=testcases,
+                       completion_endpoints=completion_endpoints,
+                       completion_parameter=completion_parameter, language=language,
+                       translate=translate, fast_template=fast_template, template=template,
+                       split=split, completion_cache=completion_cache, timeline=timeline,
+                       trace_dir=trace_dir, penalty_budget=penalty_budget)
+
+
+def parse_problems(problems, contest_id):
+  from atcoder_auto_submitter.atcoder import get_problem_ids
+
+  if problems == 'all':
+    return get_problem_ids(contest_id)
+
+  problem_ids = []
+  for part in problems.split(','):
+    if '-' in part:
+      first, last = part.split('-')
+      problem_ids.extend(chr(c) for c in range(ord(first), ord(last) + 1))
+    else:
+      problem_ids.append(part)
+  return problem_ids
+
+
+def sort_by_priority(problem_ids, priority):
+  order = priority.split(',') if priority else []
+  return sorted(problem_ids, key=lambda p: (order.index(p) if p in order else len(order), p))
+
+
+def contest_job(contest_id, problems, priority, workers, **options):
+  from atcoder_auto_submitter.atcoder import get_template
+
+  problem_ids = sort_by_priority(parse_problems(problems, contest_id), priority)
+  logger.info(f'Solving problems {problem_ids} with {workers} workers...')
+  # Each problem verifies its candidates with its own pool, so the cores are divided among them
+  cores = max((os.cpu_count() or 1) // min(workers, len(problem_ids)), 1)
+
+  # The timeline and the log of each problem start with the scraping, which is done before its job
+  timelines = {problem_id: Timeline(f'{contest_id}_{problem_id}') for problem_id in problem_ids}
+  execution_logs = {problem_id: ExecutionLog(f'{contest_id}_{problem_id}')
+                    for problem_id in problem_ids}
+
+  def solve(problem_id):
+    template = templates[problem_id].result()
+    job(problem_id=problem_id, contest_id=contest_id, template=template,
+        timeline=timelines[problem_id], execution_log=execution_logs[problem_id], cores=cores,
+        **options)
+
+  # Templates are scraped for every problem up front, so that queued jobs don't wait for scraping
+  with ThreadPoolExecutor(max_workers=len(problem_ids)) as scraper, \
+          ThreadPoolExecutor(max_workers=workers) as executor:
+    # Jobs with the tests translate the statement by themselves while completing on the original
+    translate = options['translate'] and not options['test']
+    templates = {
+        problem_id: scraper.submit(
+            run_in_scope, execution_logs[problem_id], get_template, contest_id, problem_id,
+            options['language'], translate, options['fast_template'], timelines[problem_id])
+        for problem_id in problem_ids
+    }
+    futures = {executor.submit(solve, problem_id): problem_id for problem_id in problem_ids}
+
+    for future in as_completed(futures):
+      problem_id = futures[future]
+      try:
+        future.result()
+        logger.info(f'Problem {problem_id} finished.')
+      except Exception as e:
+        logger.error(f'Problem {problem_id} failed: {e}')
+
+
+def float_list(value):
+  return [float(item) for item in value.split(',')]
+
+
+def wait_for_start(run_at, completion_endpoints):
+  from atcoder_auto_submitter.app import prewarm
+
+  logger.info(f'Waiting for the beginning of the contest at {run_at.isoformat()}...')
+  wait_until(run_at.timestamp() - PREWARM_SECONDS)
+  prewarm(completion_endpoints)
+  offset = get_clock_offset()
+  delay = wait_until(run_at.timestamp(), offset)
+  logger.info(f'Started {delay * 1000:.1f}ms after the scheduled time.')
+
+
+def run_request(request):
+  options = dict(request)
+  run_at = options.pop('run_at', None)
+  contest_options = {key: options.pop(key) for key in CONTEST_OPTIONS if key in options}
+
+  if contest_options.get('problems') is None:
+    target, target_args = job, options
   else:
-    run_without_test(problem_id, contest_id, testcases=testcases,
-                     completion_endpoint=completion_endpoint,
-                     completion_parameter=completion_parameter, language=language,
-                     translate=translate)
+    options.pop('problem_id', None)
+    target, target_args = contest_job, {**options, **contest_options}
+
+  if run_at is not None:
+    wait_for_start(parse_run_at(run_at), options['completion_endpoints'])
+
+  target(**target_args)
+
+
+def get_options(parsed_args):
+  completion_parameter = {}
+
+  if parsed_args.max_tokens is not None:
+    completion_parameter['max_tokens'] = parsed_args.max_tokens
+  # A list of values fans out into concurrent requests
+  if parsed_args.temperature is not None:
+    completion_parameter['temperature'] = \
+        parsed_args.temperature[0] if len(parsed_args.temperature) == 1 else parsed_args.temperature
+  if parsed_args.top_p is not None:
+    completion_parameter['top_p'] = \
+        parsed_args.top_p[0] if len(parsed_args.top_p) == 1 else parsed_args.top_p
+  if parsed_args.logprobs is not None:
+    completion_parameter['logprobs'] = parsed_args.logprobs
+  if parsed_args.presence_penalty is not None:
+    completion_parameter['presence_penalty'] = parsed_args.presence_penalty
+  if parsed_args.frequency_penalty is not None:
+    completion_parameter['frequency_penalty'] = parsed_args.frequency_penalty
+  if parsed_args.best_of is not None:
+    completion_parameter['best_of'] = parsed_args.best_of
+
+  return dict(
+      testcases=parsed_args.testcases,
+      completion_endpoints=parsed_args.completion_endpoints,
+      completion_parameter=completion_parameter, split=parsed_args.split,
+      completion_cache=parsed_args.completion_cache, trace_dir=parsed_args.trace_dir,
+      language=parsed_args.language, translate=parsed_args.translate, test=parsed_args.test,
+      runner=parsed_args.runner, fast_template=parsed_args.fast_template,
+      penalty_budget=parsed_args.penalty_budget, jobs=parsed_args.jobs,
+      priority=parsed_args.priority, workers=parsed_args.workers)
+
+
+def merge_options(defaults, request):
+  # Completion parameters are merged one by one, so that a job can override only some of them
+  completion_parameter = {**defaults['completion_parameter'],
+                          **request.get('completion_parameter', {})}
+  return {**defaults, **request, 'completion_parameter': completion_parameter}
+
+
+def warm_up(options):
+  from atcoder_auto_submitter.app import ADDITIONAL_LIBRARIES, prewarm
+  from atcoder_auto_submitter.atcoder import get_translator
+  from atcoder_auto_submitter.runner import preload
+
+  logger.info('Warming up the daemon...')
+  preload(ADDITIONAL_LIBRARIES)
+  if options['translate']:
+    get_translator()
+  prewarm(options['completion_endpoints'])
 
 
 def main():
@@ -42,30 +211,66 @@ def main():
 
   parser = argparse.ArgumentParser(
       description='Fully-automated AtCoder submitter backed by OpenAI Codex.', prog=prog)
-  parser.add_argument('contest_id', help='Contest ID (e.g. abc001)')
-  parser.add_argument('problem_id', help='Problem ID (e.g. a)')
+  parser.add_argument('contest_id', nargs='?', help='Contest ID (e.g. abc001)')
+  parser.add_argument('problem_id', nargs='?', help='Problem ID (e.g. a)')
+  parser.add_argument(
+      '--problems', metavar='SPEC',
+      help='Solve multiple problems of the contest concurrently instead of PROBLEM_ID. SPEC is a range (a-g), a list (a,c,e) or `all`.')
+  parser.add_argument('--workers', metavar='N', type=int, default=3,
+                      help='The number of problems solved concurrently with --problems.')
+  parser.add_argument('--priority', metavar='LIST', default='',
+                      help='Comma-separated problem IDs solved first with --problems (e.g. c,d). The rest follows in alphabetical order.')
   parser.add_argument(
-      '--run_at', metavar='HH:MM', default='',
-      help='Schedule execution of this program at the time specified. If not specified, this program runs immediately.')
+      '--run_at', metavar='TIME', default='',
+      help='Schedule execution of this program at the time specified, in the form of HH:MM[:SS] or an ISO 8601 timestamp (e.g. 2021-10-23T21:00:00+09:00). Local time is used if the timezone is omitted. If not specified, this program runs immediately.')
   parser.add_argument('--testcases', metavar='N', type=int, default=5,
                       help='The number of testcases retrieved from Codex at once.')
   parser.add_argument('--language', choices=['en', 'ja'], default='ja',
                       help='The target language extracted from the problem statement.')
   parser.add_argument(
       '--translate', action=argparse.BooleanOptionalAction, default=False,
-      help='If specified, the submitter will try to translate given statement to English using Google Translate.')
+      help='If specified, the submitter will try to translate given statement to English using Google Translate. With --test, the completion on the original statement starts without waiting for the translation.')
   parser.add_argument(
       '--test', action=argparse.BooleanOptionalAction, default=False,
       help='Validate the submission by sample cases provided by challenge description before the actual submission.')
-  parser.add_argument('--completion-endpoint', metavar='URL',
-                      default=DEFAULT_COMPLETION_API_ENDPOINT,
-                      help='The endpoint of API used for code completion.')
+  parser.add_argument(
+      '--fast-template', action=argparse.BooleanOptionalAction, default=True,
+      help='Fetch only the target problem instead of generating the whole contest workspace with atcoder-tools.')
+  parser.add_argument(
+      '--runner', choices=['oj', 'warm'], default='oj',
+      help='The backend used to run sample cases. `warm` forks each run from a process with the libraries already imported.')
+  parser.add_argument(
+      '--jobs', metavar='N', type=int, default=1,
+      help='The number of sample cases of a candidate run concurrently. The warm runner stops running the samples at the first failure.')
+  parser.add_argument(
+      '--penalty-budget', metavar='N', type=int, default=0,
+      help='Wait for the verdict of the judge, and submit the next candidate up to N times after a penalized verdict such as WA or TLE. 0 finishes the job right after the first submission.')
+  parser.add_argument(
+      '--serve', metavar='ADDRESS',
+      help='Run as a daemon accepting jobs on ADDRESS, which is a path of UNIX socket or [HOST:]PORT of HTTP. The other options are used as the defaults of the jobs.')
+  parser.add_argument(
+      '--daemon', metavar='ADDRESS',
+      help='Send the job to the daemon listening on ADDRESS instead of running it in this process. Only the options given on the command line override the defaults of the daemon.')
+  parser.add_argument(
+      '--completion-endpoint', metavar='URL', dest='completion_endpoints', action='append',
+      help='The endpoint of API used for code completion. If specified multiple times, the requests are sent to all of them concurrently.')
+  parser.add_argument(
+      '--split', metavar='N', type=int, default=1,
+      help='Split the testcases of each endpoint and parameter set into N concurrent requests.')
+  parser.add_argument(
+      '--completion-cache', choices=['off', 'on', 'refresh'], default='off',
+      help='Cache the candidates on disk by the prompt and the parameters. `on` uses the cached candidates instead of the request, and `refresh` serves them while a fresh request runs.')
+  parser.add_argument(
+      '--trace-dir', metavar='DIR',
+      help='Export the timing of the phases of each job to DIR as JSON lines and a Chrome trace, which can be opened with Perfetto.')
   parser.add_argument('--max-tokens', type=int, default=2048,
                       help='`max_tokens` parameter of OpenAI API.')
-  parser.add_argument('--temperature', type=float,
-                      help='`temperature` parameter of OpenAI API.')
-  parser.add_argument('--top-p', type=float,
-                      help='`top_p` parameter of OpenAI API.')
+  parser.add_argument(
+      '--temperature', type=float_list,
+      help='`temperature` parameter of OpenAI API. If comma-separated values are given (e.g. 0.2,0.8), a request is sent for each of them concurrently.')
+  parser.add_argument(
+      '--top-p', type=float_list,
+      help='`top_p` parameter of OpenAI API. If comma-separated values are given (e.g. 0.9,1), a request is sent for each of them concurrently.')
   parser.add_argument('--logprobs', type=int,
                       help='`logprobs` parameter of OpenAI API.')
   parser.add_argument('--presence-penalty', type=float,
@@ -76,43 +281,59 @@ def main():
                       help='`best_of` parameter of OpenAI API.')
 
   parsed_args = parser.parse_args(args)
+  # Parsed again over a namespace without the defaults, so that only the options given on the
+  # command line are set
+  given_args = parser.parse_args(args, argparse.Namespace(**dict.fromkeys(vars(parsed_args))))
 
-  completion_parameter = {}
+  if parsed_args.serve is None:
+    if parsed_args.contest_id is None:
+      parser.error('contest_id must be specified')
+    if (parsed_args.problem_id is None) == (parsed_args.problems is None):
+      parser.error('either problem_id or --problems must be specified')
 
-  if parsed_args.max_tokens is not None:
-    completion_parameter['max_tokens'] = parsed_args.max_tokens
-  if parsed_args.temperature is not None:
-    completion_parameter['temperature'] = parsed_args.temperature
-  if parsed_args.top_p is not None:
-    completion_parameter['top_p'] = parsed_args.top_p
-  if parsed_args.logprobs is not None:
-    completion_parameter['logprobs'] = parsed_args.logprobs
-  if parsed_args.presence_penalty is not None:
-    completion_parameter['presence_penalty'] = parsed_args.presence_penalty
-  if parsed_args.frequency_penalty is not None:
-    completion_parameter['frequency_penalty'] = parsed_args.frequency_penalty
-  if parsed_args.best_of is not None:
-    completion_parameter['best_of'] = parsed_args.best_of
+  run_at = None
+  if parsed_args.run_at != '':
+    try:
+      run_at = parse_run_at(parsed_args.run_at)
+    except ValueError:
+      parser.error(f'invalid time for --run_at: {parsed_args.run_at}')
+
+  options = get_options(parsed_args)
+  options['completion_endpoints'] = \
+      options['completion_endpoints'] or [DEFAULT_COMPLETION_API_ENDPOINT]
+
+  if parsed_args.serve is not None:
+    warm_up(options)
+    serve(parsed_args.serve, lambda request: run_request(merge_options(options, request)))
+    return
 
   logger.info(f'Loaded config: contest = {parsed_args.contest_id}')
-  logger.info(f'Loaded config: problem = {parsed_args.problem_id}')
 
-  if parsed_args.run_at == '':
-    job(problem_id=parsed_args.problem_id, contest_id=parsed_args.contest_id,
-        testcases=parsed_args.testcases, completion_endpoint=parsed_args.completion_endpoint,
-        completion_parameter=completion_parameter, language=parsed_args.language,
-        translate=parsed_args.translate, test=parsed_args.test)
+  if parsed_args.daemon is None:
+    request = dict(options)
+  else:
+    # Only the options given on the command line override the defaults of the daemon
+    request = {key: value for key, value in get_options(given_args).items() if value is not None}
+  request['contest_id'] = parsed_args.contest_id
+  if parsed_args.problems is None:
+    logger.info(f'Loaded config: problem = {parsed_args.problem_id}')
+    request['problem_id'] = parsed_args.problem_id
   else:
-    schedule.every().day.at(parsed_args.run_at).do(
-        job, problem_id=parsed_args.problem_id, contest_id=parsed_args.contest_id,
-        testcases=parsed_args.testcases, completion_endpoint=parsed_args.completion_endpoint,
-        completion_parameter=completion_parameter, language=parsed_args.language,
-        translate=parsed_args.translate, test=parsed_args.test)
-
-    logger.info('Waiting for the beginning of the contest...')
-    while True:
-      schedule.run_pending()
-      sleep(0.1)
+    logger.info(f'Loaded config: problems = {parsed_args.problems}')
+    request['problems'] = parsed_args.problems
+  if run_at is not None:
+    request['run_at'] = run_at.isoformat()
+
+  if parsed_args.daemon is None:
+    run_request(request)
+    return
+
+  logger.info(f'Sending the job to the daemon on {parsed_args.daemon}...')
+  result = submit_job(parsed_args.daemon, request)
+  if result['status'] != 'finished':
+    logger.error(f'Job {result["status"]}: {result.get("error")}')
+    sys.exit(1)
+  logger.info('Job finished.')
 
 
 if __name__ == "__main__":
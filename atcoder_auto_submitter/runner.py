@@ -0,0 +1,163 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import signal
+import select
+import importlib
+import traceback
+from collections import deque
+from pathlib import Path
+from tempfile import TemporaryFile
+from time import perf_counter
+from atcodertools.common.logging import logger
+from atcoder_auto_submitter.cache import load_sample_stats
+
+TIME_LIMIT = 1
+MEMORY_LIMIT = 50
+
+EXIT_MEMORY_ERROR = 120
+
+
+def preload(libraries):
+  for library in libraries:
+    importlib.import_module(library.split(' as ')[0])
+
+
+def get_rss():
+  with open('/proc/self/statm') as f:
+    pages = int(f.read().split()[1])
+  return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def exec_submission(submission, input_path, output_fd):
+  try:
+    with open(input_path, 'rb') as f:
+      os.dup2(f.fileno(), 0)
+    os.dup2(output_fd, 1)
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    exec(compile(submission, '<submission>', 'exec'), {'__name__': '__main__'})
+    status = 0
+  except SystemExit as e:
+    status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+  except MemoryError:
+    status = EXIT_MEMORY_ERROR
+  except BaseException:
+    traceback.print_exc()
+    status = 1
+
+  try:
+    sys.stdout.flush()
+  except BaseException:
+    status = status or 1
+  os._exit(status)
+
+
+class SampleRun:
+  def __init__(self, submission, input_path):
+    self.input_path = input_path
+    self.output = TemporaryFile()
+    # The child shares the pages of this process, so only the growth is charged to the submission
+    self.base_rss = get_rss()
+    self.started_at = perf_counter()
+
+    self.pid = os.fork()
+    if self.pid == 0:
+      exec_submission(submission, input_path, self.output.fileno())
+    self.pidfd = os.pidfd_open(self.pid)
+
+  def kill(self):
+    os.kill(self.pid, signal.SIGKILL)
+
+  def finish(self, time_limit, memory_limit):
+    os.close(self.pidfd)
+    _, status, rusage = os.wait4(self.pid, 0)
+    elapsed = perf_counter() - self.started_at
+    memory = max(rusage.ru_maxrss / 1024 - self.base_rss, 0)
+
+    with self.output:
+      self.output.seek(0)
+      actual = self.output.read()
+
+    if elapsed > time_limit:
+      verdict = 'TLE'
+    elif os.waitstatus_to_exitcode(status) == EXIT_MEMORY_ERROR or memory > memory_limit:
+      verdict = 'MLE'
+    elif os.waitstatus_to_exitcode(status) != 0:
+      verdict = 'RE'
+    else:
+      expected = self.input_path.with_suffix('.out').read_bytes()
+      # Same as crlf-insensitive-exact-match of oj test
+      if actual.replace(b'\r\n', b'\n') == expected.replace(b'\r\n', b'\n'):
+        verdict = 'AC'
+      else:
+        verdict = 'WA'
+
+    return dict(name=self.input_path.stem, verdict=verdict, elapsed=elapsed, memory=memory,
+                started_at=self.started_at)
+
+
+def get_sample_order(input_paths, stats):
+  # Samples failed most often go first, then the fastest ones, so that a wrong candidate fails early
+  def key(input_path):
+    stat = stats.get(input_path.stem, {})
+    return -stat.get('failures', 0), stat.get('elapsed', 0), input_path.name
+  return sorted(input_paths, key=key)
+
+
+def run_tests(submission, testdir, time_limit=TIME_LIMIT, memory_limit=MEMORY_LIMIT, jobs=1):
+  input_paths = get_sample_order(Path(testdir).glob('*.in'), load_sample_stats(testdir))
+  if len(input_paths) == 0:
+    logger.error('No test cases found.')
+    return 1, []
+
+  queue = deque(input_paths)
+  running = {}
+  samples = []
+  failed = False
+
+  while len(running) > 0 or (len(queue) > 0 and not failed):
+    while len(queue) > 0 and not failed and len(running) < jobs:
+      run = SampleRun(submission, queue.popleft())
+      running[run.pidfd] = run
+
+    deadline = min(run.started_at for run in running.values()) + time_limit
+    ready, _, _ = select.select(list(running), [], [], max(deadline - perf_counter(), 0))
+
+    for pidfd, run in list(running.items()):
+      if pidfd not in ready and perf_counter() < run.started_at + time_limit:
+        continue
+      if pidfd not in ready:
+        run.kill()
+      del running[pidfd]
+
+      sample = run.finish(time_limit, memory_limit)
+      logger.info(f'{sample["name"]}: {sample["verdict"]} '
+                  f'({sample["elapsed"]:.3f}s, {sample["memory"]:.1f}MB)')
+      samples.append(sample)
+      failed = failed or sample['verdict'] != 'AC'
+
+    if failed:
+      # The candidate is already rejected, so the rest of the samples are not worth waiting for
+      for run in running.values():
+        run.kill()
+        run.finish(time_limit, memory_limit)
+      skipped = len(running) + len(queue)
+      if skipped > 0:
+        logger.info(f'Skipped {skipped} samples after the failure.')
+      running.clear()
+
+  return (1 if failed else 0), samples
@@ -0,0 +1,103 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, time as dt_time, timedelta
+from email.utils import parsedate_to_datetime
+from time import time, sleep
+from atcodertools.common.logging import logger
+
+# The last part of the wait is spent on busy-waiting, since sleep() may oversleep by a few ms
+SPIN_SECONDS = 0.02
+
+CLOCK_SAMPLES = 8
+
+
+def backoff(initial=0.05, maximum=0.5, factor=1.5):
+  delay = initial
+  while True:
+    yield delay
+    delay = min(delay * factor, maximum)
+
+
+def parse_run_at(value, now=None):
+  now = now or datetime.now().astimezone()
+  try:
+    run_at = datetime.fromisoformat(value)
+  except ValueError:
+    # Only the time of day is given, which means its next occurrence
+    run_at_time = dt_time.fromisoformat(value)
+    run_at = datetime.combine(now.date(), run_at_time)
+    if run_at.tzinfo is None:
+      run_at = run_at.astimezone()
+    if run_at <= now:
+      run_at += timedelta(days=1)
+
+  if run_at.tzinfo is None:
+    run_at = run_at.astimezone()
+  return run_at
+
+
+def get_clock_offset(url=None):
+  # Date header has only 1s resolution. Each response bounds the offset to a 1s window,
+  # so requests at different phases of a second narrow it down by intersection.
+  import requests
+  from atcoder_auto_submitter.session import ATCODER_URL, get_session
+
+  url = url or ATCODER_URL
+  session = get_session(url)
+  lower, upper = float('-inf'), float('inf')
+
+  for _ in range(CLOCK_SAMPLES):
+    sent_at = time()
+    try:
+      res = session.head(url, timeout=5)
+    except requests.RequestException as e:
+      logger.warning(f'Failed to get the server time: {e}')
+      continue
+    received_at = time()
+
+    date = res.headers.get('Date')
+    if date is None:
+      continue
+    server_time = parsedate_to_datetime(date).timestamp()
+    lower = max(lower, server_time - received_at)
+    upper = min(upper, server_time + 1 - sent_at)
+
+    # Shifts the phase of the next request by a fraction of a second
+    sleep(max(1 / CLOCK_SAMPLES - (received_at - sent_at), 0))
+
+  if lower > upper or lower == float('-inf') or upper == float('inf'):
+    logger.warning('Could not determine the clock offset. Using the local clock.')
+    return 0.0
+
+  offset = (lower + upper) / 2
+  logger.info(f'Clock offset against the server: {offset * 1000:+.0f}ms '
+              f'(+/- {(upper - lower) * 500:.0f}ms)')
+  return offset
+
+
+def wait_until(timestamp, offset=0.0):
+  # The offset is the server clock minus the local clock
+  deadline = timestamp - offset
+
+  while True:
+    remaining = deadline - time()
+    if remaining <= SPIN_SECONDS:
+      break
+    sleep(min(remaining - SPIN_SECONDS, 1))
+
+  while time() < deadline:
+    pass
+
+  return time() - deadline
@@ -0,0 +1,43 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Lock
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from atcodertools.client.atcoder import AtCoderClient
+
+ATCODER_URL = 'https://atcoder.jp/'
+
+# Enough for the completion streams and the sample runs of all problems solved concurrently
+POOL_MAXSIZE = 16
+
+sessions = {}
+sessions_lock = Lock()
+
+
+def get_session(url):
+  host = urlparse(url).netloc
+  with sessions_lock:
+    if host not in sessions:
+      if host == urlparse(ATCODER_URL).netloc:
+        # Shares the cookies and the connections with atcoder-tools
+        session = AtCoderClient()._session
+      else:
+        session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      sessions[host] = session
+    return sessions[host]
@@ -0,0 +1,114 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from threading import Lock, current_thread
+from time import perf_counter
+from atcodertools.common.logging import logger
+
+
+class Timeline:
+  def __init__(self, name):
+    self.name = name
+    self.origin = perf_counter()
+    self.stages = []
+    self.lock = Lock()
+
+  def add(self, name, started_at, finished_at, lane=None, args=None):
+    # perf_counter is system-wide on Linux, so timestamps taken in pool workers are also accepted
+    lane = lane or current_thread().name
+    with self.lock:
+      self.stages.append((name, started_at - self.origin, finished_at - self.origin,
+                          lane, args or {}))
+
+  def mark(self, name, **args):
+    now = perf_counter()
+    self.add(name, now, now, args=args)
+
+  @contextmanager
+  def stage(self, name, **args):
+    # The body may add the attributes known only at the end to the yielded dict
+    started_at = perf_counter()
+    try:
+      yield args
+    finally:
+      self.add(name, started_at, perf_counter(), args=args)
+
+  def run(self, name, f, *args, **kwargs):
+    with self.stage(name):
+      return f(*args, **kwargs)
+
+  def get_stages(self):
+    with self.lock:
+      return sorted(self.stages, key=lambda stage: stage[1])
+
+  def log(self):
+    stages = self.get_stages()
+
+    logger.info(f'Timeline of {self.name}:')
+    for name, started_at, finished_at, _, args in stages:
+      # Lists such as the results of samples are left to the exported trace
+      attributes = ', '.join(
+          f'{key} = {value:.3f}' if isinstance(value, float) else f'{key} = {value}'
+          for key, value in args.items() if not isinstance(value, (list, dict)))
+      logger.info(f'  {started_at:8.3f}s - {finished_at:8.3f}s ({finished_at - started_at:7.3f}s) '
+                  f'{name}' + (f' ({attributes})' if attributes else ''))
+
+    summary = {}
+    for name, started_at, finished_at, _, _ in stages:
+      durations = summary.setdefault(name, [])
+      durations.append(finished_at - started_at)
+
+    logger.info(f'Summary of {self.name}:')
+    logger.info(f'  {"phase":<20} {"count":>5} {"total":>9} {"mean":>9} {"max":>9}')
+    for name, durations in summary.items():
+      logger.info(f'  {name:<20} {len(durations):>5} {sum(durations):8.3f}s '
+                  f'{sum(durations) / len(durations):8.3f}s {max(durations):8.3f}s')
+
+  def export(self, trace_dir):
+    trace_dir = Path(trace_dir)
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    stem = f'{self.name}-{datetime.now():%Y%m%d-%H%M%S}'
+    stages = self.get_stages()
+
+    with (trace_dir / f'{stem}.jsonl').open('w') as f:
+      for name, started_at, finished_at, lane, args in stages:
+        record = dict(name=name, start=started_at, end=finished_at,
+                      duration=finished_at - started_at, lane=lane, args=args)
+        f.write(json.dumps(record, default=str) + '\n')
+
+    # Chrome trace format, which is also read by Perfetto. Each lane becomes a thread.
+    pid = os.getpid()
+    lanes = {}
+    events = [dict(name='process_name', ph='M', pid=pid, tid=0, args=dict(name=self.name))]
+    for name, started_at, finished_at, lane, args in stages:
+      if lane not in lanes:
+        lanes[lane] = len(lanes) + 1
+        events.append(dict(name='thread_name', ph='M', pid=pid, tid=lanes[lane],
+                           args=dict(name=lane)))
+      event = dict(name=name, pid=pid, tid=lanes[lane], ts=started_at * 1e6, args=args)
+      if finished_at == started_at:
+        event.update(ph='i', s='t')
+      else:
+        event.update(ph='X', dur=(finished_at - started_at) * 1e6)
+      events.append(event)
+
+    with (trace_dir / f'{stem}.trace.json').open('w') as f:
+      json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f, default=str)
+
+    logger.info(f'Trace exported to {trace_dir / stem}.jsonl and {trace_dir / stem}.trace.json')
@@ -0,0 +1,153 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+from collections import deque
+from multiprocessing import Pool
+from pathlib import Path
+from time import perf_counter, sleep
+from atcodertools.common.logging import logger
+from atcoder_auto_submitter.cache import update_sample_stats
+
+
+def get_children():
+  # (pid, process group) of the children of this process
+  children = []
+  for stat_path in Path('/proc').glob('[0-9]*/stat'):
+    try:
+      stat = stat_path.read_text()
+    except OSError:
+      continue
+    # The command name in parentheses may contain spaces
+    _, ppid, pgrp = stat.rsplit(')', 1)[1].split()[:3]
+    if int(ppid) == os.getpid():
+      children.append((int(stat_path.parent.name), int(pgrp)))
+  return children
+
+
+def kill_children(signum, frame):
+  # A terminated worker would leave the candidate it was running behind. oj starts the candidate
+  # in its own session, so the whole group of such a child is killed.
+  for pid, pgrp in get_children():
+    try:
+      if pgrp == pid:
+        os.killpg(pgrp, signal.SIGKILL)
+      else:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+
+  signal.signal(signum, signal.SIG_DFL)
+  os.kill(os.getpid(), signum)
+
+
+def init_worker():
+  signal.signal(signal.SIGTERM, kill_children)
+
+
+def timed_verify(verify, *args):
+  started_at = perf_counter()
+  exit_code, samples = verify(*args)
+  return exit_code, samples, started_at, perf_counter(), os.getpid()
+
+
+class Verifier:
+  def __init__(self, verify, testdir, workers=None, timeline=None, on_done=None):
+    self.verify = verify
+    self.testdir = testdir
+    self.workers = workers or os.cpu_count() or 1
+    self.timeline = timeline
+    self.on_done = on_done
+    self.pool = Pool(processes=self.workers, initializer=init_worker)
+    # Verifications in the order of dispatch, which is also the order of tie-break
+    self.running = deque()
+    self.verdicts = []
+
+    logger.info(f'Started verification pool with {self.workers} workers.')
+
+  def add(self, choice, code, execution_log, candidates):
+    outcome = {}
+
+    # Called from the result handler thread of the pool, before the result becomes ready()
+    def done(value):
+      outcome['value'] = value
+      if self.on_done is not None:
+        self.on_done()
+
+    self.pool.apply_async(
+        timed_verify, (self.verify, code, execution_log, candidates, choice, self.testdir),
+        callback=done, error_callback=done)
+    self.running.append((choice, code, outcome))
+
+  def count_idle(self):
+    return self.workers - sum('value' not in outcome for _, _, outcome in self.running)
+
+  def poll(self, block=False):
+    while len(self.running) > 0:
+      choice, code, outcome = self.running[0]
+      if 'value' not in outcome:
+        if not block:
+          return None
+        sleep(0.01)
+        continue
+
+      self.running.popleft()
+      if isinstance(outcome['value'], BaseException):
+        raise outcome['value']
+
+      exit_code, samples, started_at, finished_at, pid = outcome['value']
+      elapsed = finished_at - started_at
+      verdict = 'passed' if exit_code == 0 else 'failed'
+
+      # Workers read the stats to order the samples, and only this process writes them
+      if len(samples) > 0:
+        update_sample_stats(self.testdir, samples)
+
+      if self.timeline is not None:
+        self.add_stages(choice, verdict, samples, started_at, finished_at, pid)
+
+      self.verdicts.append((choice, verdict, elapsed))
+      logger.info(f'Candidate {choice} {verdict} in {elapsed:.2f}s.')
+
+      if exit_code == 0:
+        return choice, code
+
+    return None
+
+  def add_stages(self, choice, verdict, samples, started_at, finished_at, pid):
+    # Each worker gets its own lane, since the verifications overlap each other
+    lane = f'verifier {pid}'
+    results = [{key: value for key, value in sample.items() if key != 'started_at'}
+               for sample in samples]
+    self.timeline.add('verify_code', started_at, finished_at, lane=lane,
+                      args=dict(candidate=choice, verdict=verdict, samples=results))
+
+    # oj doesn't tell when each sample started, so only the warm runner has the spans of samples
+    for sample, result in zip(samples, results):
+      if 'started_at' in sample:
+        self.timeline.add('run_sample', sample['started_at'],
+                          sample['started_at'] + sample['elapsed'], lane=lane,
+                          args=dict(candidate=choice, **result))
+
+  def close(self):
+    for choice, _, _ in self.running:
+      self.verdicts.append((choice, 'cancelled', None))
+    self.running.clear()
+    self.pool.terminate()
+
+    logger.info('Verification summary:')
+    for choice, verdict, elapsed in self.verdicts:
+      timing = '-' if elapsed is None else f'{elapsed:.2f}s'
+      logger.info(f'  Candidate {choice}: {verdict} ({timing})')
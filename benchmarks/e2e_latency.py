@@ -0,0 +1,301 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the end-to-end latency of a job without network access.
+#
+#   PYTHONPATH=. python benchmarks/e2e_latency.py --repeat 5
+#
+# Each problem of a corpus is a directory named after the task (e.g. abc001_a) with
+#
+#   task.html     The task page served by the fake AtCoder
+#   stream.jsonl  The recorded completion stream replayed by the mock completion server. Each line
+#                 is {"offset": seconds since the request, "data": SSE data}, and the last one has
+#                 "[DONE]" as the data. At least one of the candidates must pass the samples.
+#
+# The corpus in this directory is a synthetic smoke fixture, marked by its SYNTHETIC file, whose
+# streams are made up. Its runs are only listed with the maximum of each metric, and percentiles
+# are reported for a corpus of recorded streams given with --corpus.
+#
+# Task pages and sample cases are fetched by the real code of atcoder-tools and oj, through the
+# shared session of atcoder.jp routed to the fake AtCoder. Submission is replaced with a stand-in
+# posting the code to the fake AtCoder, since oj needs the real submission pages of AtCoder. The
+# fake judge takes JUDGE_SECONDS for each submission, and the verdicts are polled as usual with
+# --penalty-budget.
+
+import re
+import json
+import argparse
+import threading
+from itertools import count
+from math import ceil
+from pathlib import Path
+from time import perf_counter, sleep
+from urllib.parse import parse_qs
+from tempfile import TemporaryDirectory
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from atcodertools.common.logging import logger
+from atcoder_auto_submitter import app, atcoder, cache
+from atcoder_auto_submitter.session import ATCODER_URL, get_session
+from atcoder_auto_submitter.verifier import Verifier
+
+CORPUS_DIR = Path(__file__).parent / 'corpus'
+
+METRICS = ['first candidate', 'verified', 'submitted', 'accepted']
+
+JUDGE_SECONDS = 0.5
+
+PERCENTILES = [50, 90, 99]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def handle(self):
+    try:
+      super().handle()
+    except (BrokenPipeError, ConnectionResetError):
+      # The client closes the stream once all the candidates are completed
+      pass
+
+  def do_GET(self):
+    path = self.path.split('?')[0]
+
+    # Logged-in page checked by atcoder-tools
+    if path == '/home':
+      self.send_body(b'<a href="/settings">Settings</a>', 'text/html')
+      return
+
+    if re.fullmatch(r'/contests/\w+/submissions/me/status/json', path):
+      submission_id = parse_qs(self.path.split('?')[1])['sids[]'][0]
+      self.send_body(json.dumps(self.get_status(submission_id)).encode(), 'application/json')
+      return
+
+    match = re.fullmatch(r'/contests/\w+/tasks/(\w+)', path)
+    task = match and self.server.corpus_dir / match[1] / 'task.html'
+    if task is None or not task.exists():
+      self.send_error(404)
+      return
+    self.send_body(task.read_bytes(), 'text/html; charset=utf-8')
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    match = re.fullmatch(r'/contests/(\w+)/submit', self.path)
+    if match is not None:
+      task = parse_qs(body.decode())['data.TaskScreenName'][0]
+      submission_id = next(self.server.submission_ids)
+      # With --reject-first, the first submission of each run is judged as WA
+      rejected = self.server.reject_first and task not in self.server.submitted_tasks
+      self.server.submitted_tasks.add(task)
+      self.server.submissions[str(submission_id)] = (perf_counter(), 'WA' if rejected else 'AC')
+      self.send_body(json.dumps({'id': submission_id}).encode(), 'application/json')
+      return
+
+    match = re.fullmatch(r'/(\w+)/completions', self.path)
+    stream = match and self.server.corpus_dir / match[1] / 'stream.jsonl'
+    if stream is None or not stream.exists():
+      self.send_error(404)
+      return
+    self.replay(stream)
+
+  def get_status(self, submission_id):
+    submitted_at, verdict = self.server.submissions[submission_id]
+    progress = (perf_counter() - submitted_at) / JUDGE_SECONDS
+    if progress < 0.5:
+      label = 'WJ'
+    elif progress < 1:
+      label = '1/2'
+    else:
+      label = verdict
+    html = f"<td class='text-center'><span class='label label-default'>{label}</span></td>"
+    return {'Result': {submission_id: {'Html': html, 'Score': '0'}}, 'Interval': 100}
+
+  def replay(self, stream):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+
+    started_at = perf_counter()
+    with stream.open() as f:
+      for line in f:
+        event = json.loads(line)
+        delay = started_at + event['offset'] * self.server.time_scale - perf_counter()
+        if delay > 0:
+          sleep(delay)
+        data = event['data'] if isinstance(event['data'], str) else json.dumps(event['data'])
+        self.send_chunk(f'data: {data}\n\n'.encode())
+    self.wfile.write(b'0\r\n\r\n')
+
+  def send_chunk(self, data):
+    self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+    self.wfile.flush()
+
+  def send_body(self, data, content_type):
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class LocalAdapter(HTTPAdapter):
+  def __init__(self, origin):
+    super().__init__()
+    self.origin = origin
+
+  def send(self, request, **kwargs):
+    request.url = self.origin + request.url[len(ATCODER_URL) - 1:]
+    return super().send(request, **kwargs)
+
+
+class Probe:
+  def __init__(self):
+    self.started_at = perf_counter()
+    self.marks = {}
+
+  def mark(self, name):
+    self.marks.setdefault(name, perf_counter() - self.started_at)
+
+
+def install_probes(probes, origin):
+  stream_completions = app.stream_completions
+
+  def probed_stream_completions(*args, **kwargs):
+    for completion in stream_completions(*args, **kwargs):
+      probes[-1].mark('first candidate')
+      yield completion
+
+  class ProbedVerifier(Verifier):
+    def poll(self, block=False):
+      passed = super().poll(block)
+      if passed is not None:
+        probes[-1].mark('verified')
+      return passed
+
+  def submit_code(code, execution_log, candidates, choice, contest, problem_id):
+    res = get_session(ATCODER_URL).post(f'{ATCODER_URL}contests/{contest}/submit', data={
+        'data.TaskScreenName': f'{contest}_{problem_id}',
+        'sourceCode': code,
+    })
+    probes[-1].mark('submitted')
+    return res.json()['id'] if res.ok else None
+
+  judge_submission = app.judge_submission
+
+  def probed_judge_submission(*args):
+    verdict = judge_submission(*args)
+    if verdict == 'AC':
+      probes[-1].mark('accepted')
+    return verdict
+
+  app.stream_completions = probed_stream_completions
+  app.Verifier = ProbedVerifier
+  app.submit_code = submit_code
+  app.judge_submission = probed_judge_submission
+
+  get_session(ATCODER_URL).mount(ATCODER_URL.rstrip('/'), LocalAdapter(origin))
+  # The fake AtCoder accepts any session, so the interactive login is skipped
+  atcoder.logged_in = True
+  app.OPENAI_TOKEN = app.OPENAI_TOKEN or 'benchmark'
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[max(ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Offline benchmark of the end-to-end latency.')
+  parser.add_argument('--corpus', type=Path, default=CORPUS_DIR,
+                      help='The directory of recorded problems. Defaults to the synthetic corpus.')
+  parser.add_argument('--repeat', type=int, default=3, help='The number of runs per problem.')
+  parser.add_argument('--test', action=argparse.BooleanOptionalAction, default=True,
+                      help='Run run_with_test instead of run_without_test.')
+  parser.add_argument('--runner', choices=['oj', 'warm'], default='warm',
+                      help='The backend used to run sample cases.')
+  parser.add_argument('--testcases', type=int, default=3,
+                      help='The number of testcases requested from the mock completion server.')
+  parser.add_argument('--time-scale', type=float, default=1.0,
+                      help='Scale of the recorded timings of the streams. 0 replays them at once.')
+  parser.add_argument('--penalty-budget', metavar='N', type=int, default=0,
+                      help='Wait for the verdicts, and resubmit up to N times after WA.')
+  parser.add_argument('--reject-first', action='store_true',
+                      help='Judge the first submission of each run as WA.')
+  parser.add_argument('--trace-dir', metavar='DIR', help='Export the trace of each run to DIR.')
+  parser.add_argument('--verbose', action='store_true', help='Show the logs of the jobs.')
+  args = parser.parse_args()
+
+  if not args.verbose:
+    logger.setLevel('WARNING')
+
+  server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+  server.daemon_threads = True
+  server.corpus_dir = args.corpus
+  server.time_scale = args.time_scale
+  server.reject_first = args.reject_first
+  server.submission_ids = count(1)
+  server.submissions = {}
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  origin = f'http://127.0.0.1:{server.server_address[1]}'
+
+  probes = []
+  install_probes(probes, origin)
+
+  tasks = sorted(path.name for path in args.corpus.iterdir() if (path / 'task.html').exists())
+  for task in tasks:
+    contest_id, problem_id = task.rsplit('_', 1)
+    for _ in range(args.repeat):
+      # Caches are cleared for every run, so that every run downloads the test cases
+      with TemporaryDirectory() as cache_dir:
+        cache.CACHE_DIR = Path(cache_dir)
+        server.submitted_tasks = set()
+        probes.append(Probe())
+        run = app.run_with_test if args.test else app.run_without_test
+        run_args = dict(runner=args.runner) if args.test else {}
+        run(problem_id, contest_id, testcases=args.testcases,
+            completion_endpoints=[f'{origin}/{task}/completions'], completion_parameter={},
+            language='en', translate=False, completion_cache='off', trace_dir=args.trace_dir,
+            penalty_budget=args.penalty_budget, **run_args)
+      marks = ', '.join(f'{name} {time:.3f}s' for name, time in probes[-1].marks.items())
+      print(f'{task}: {marks}')
+
+  server.shutdown()
+
+  print()
+  if (args.corpus / 'SYNTHETIC').exists():
+    print('Synthetic corpus, whose timings are not representative. Percentiles are omitted.')
+    print(f'{"metric":<16} {"runs":>4} {"max":>8}')
+    for metric in METRICS:
+      times = [probe.marks[metric] for probe in probes if metric in probe.marks]
+      if len(times) > 0:
+        print(f'{metric:<16} {len(times):>4} {max(times):7.3f}s')
+    return
+
+  percentiles = ' '.join(f'{f"p{p}":>8}' for p in PERCENTILES)
+  print(f'{"metric":<16} {"runs":>4} {percentiles} {"max":>8}')
+  for metric in METRICS:
+    times = [probe.marks[metric] for probe in probes if metric in probe.marks]
+    if len(times) == 0:
+      continue
+    print(f'{metric:<16} {len(times):>4} ' +
+          ' '.join(f'{percentile(times, p):7.3f}s' for p in PERCENTILES) + f' {max(times):7.3f}s')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,145 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the statement extraction and normalization with the previous implementation based on
+# BeautifulSoup and chained str.replace, over saved task pages.
+#
+#   PYTHONPATH=. python benchmarks/statement_latency.py --repeat 100
+#   PYTHONPATH=. python benchmarks/statement_latency.py path/to/pages/*.html
+
+import argparse
+import statistics
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from bs4 import BeautifulSoup
+from atcoder_auto_submitter.atcoder import extract_statement, normalize_statement_line
+
+CORPUS_DIR = Path(__file__).parent / 'corpus'
+
+
+def legacy_extract_statement(problem_html, language):
+  soup = BeautifulSoup(problem_html, features="lxml")
+  en_descriptions = soup.find("span", {"class": f'lang-{language}'})
+  if en_descriptions is None:
+    raise Exception(f'Statement with language = {language} not found')
+  en_sections = en_descriptions.find_all("div", {"class": "part"})
+  en_statement = en_sections[0]
+
+  en_output_section = None
+  for section in en_sections:
+    h3 = section.find('h3')
+    if h3 and h3.get_text() == 'Output':
+      en_output_section = section
+
+  en_statement_lines = []
+  for tag in en_statement.find_all(['p', 'ul', 'ol']):
+    if tag.name == 'p':
+      en_statement_lines.extend(tag.get_text().split('\r\n'))
+    else:
+      li_elements = tag.find_all('li')
+      if tag.name == 'ul':
+        en_statement_lines.extend(map(lambda el: f'* {el.get_text()}', li_elements))
+      elif tag.name == 'ol':
+        en_statement_lines.extend(map(
+            lambda d: f'{d[0] + 1}. {d[1].get_text()}',
+            enumerate(li_elements)
+        ))
+
+  if en_output_section is not None:
+    codes = en_output_section.find('code')
+    if codes is not None or '-1' in en_output_section.get_text():
+      for tag in en_output_section.find_all('p'):
+        en_statement_lines.extend(tag.get_text().split('\r\n'))
+
+  return en_statement_lines
+
+
+def legacy_normalize_statement_line(line):
+  return line \
+      .replace('\\neq', '!=') \
+      .replace('\\,', ' ') \
+      .replace('\\times', 'x') \
+      .replace('\\leq', '<=') \
+      .replace('\\le', '<=') \
+      .replace('\\lt', '<') \
+      .replace('\\geq', '>=') \
+      .replace('\\ge', '>=') \
+      .replace('\\gt', '>') \
+      .replace('\\dots', '...') \
+      .replace('\\cdots', '...') \
+      .replace('\\ldots', '...') \
+      .replace('^', ' ** ') \
+      .replace('\\mathrm', '') \
+      .strip()
+
+
+def measure(f, inputs, repeat):
+  times = []
+  for _ in range(repeat):
+    started_at = perf_counter()
+    for value in inputs:
+      f(value)
+    times.append(perf_counter() - started_at)
+
+  # Allocations are traced in a separate pass, since tracemalloc slows down the measured code
+  tracemalloc.start()
+  for value in inputs:
+    f(value)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return times, peak
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark of statement extraction.')
+  parser.add_argument('pages', nargs='*', type=Path,
+                      help='Saved task pages. Defaults to the task pages of the corpus.')
+  parser.add_argument('--language', default='en', help='The language of the statement.')
+  parser.add_argument('--repeat', type=int, default=100, help='The number of passes per path.')
+  args = parser.parse_args()
+
+  pages = [path.read_text() for path in args.pages or sorted(CORPUS_DIR.glob('*/task.html'))]
+  lines = [line for page in pages for line in extract_statement(page, args.language)]
+
+  for page in pages:
+    if extract_statement(page, args.language) != legacy_extract_statement(page, args.language):
+      raise Exception('Extracted statements differ from the previous implementation')
+  # The previous chain replaced \le inside \left and so on, so only the differences are reported
+  for line in lines:
+    if normalize_statement_line(line) != legacy_normalize_statement_line(line):
+      print(f'normalized differently: {line!r}')
+      print(f'  previous: {legacy_normalize_statement_line(line)!r}')
+      print(f'  current:  {normalize_statement_line(line)!r}')
+
+  results = [
+      ('extract', 'previous', measure(lambda page: legacy_extract_statement(page, args.language),
+                                      pages, args.repeat)),
+      ('extract', 'current', measure(lambda page: extract_statement(page, args.language),
+                                     pages, args.repeat)),
+      ('normalize', 'previous', measure(legacy_normalize_statement_line, lines, args.repeat)),
+      ('normalize', 'current', measure(normalize_statement_line, lines, args.repeat)),
+  ]
+
+  print(f'{len(pages)} pages, {len(lines)} lines')
+  print(f'{"stage":<10} {"path":<9} {"median":>9} {"min":>9} {"max":>9} {"peak":>9}')
+  for stage, name, (times, peak) in results:
+    print(f'{stage:<10} {name:<9} ' +
+          ' '.join(f'{time * 1000:7.3f}ms' for time in
+                   (statistics.median(times), min(times), max(times))) +
+          f' {peak / 1024:7.1f}KB')
+
+
+if __name__ == '__main__':
+  main()
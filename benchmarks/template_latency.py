@@ -0,0 +1,55 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the latency of the single-problem fast path of get_template with the envgen path.
+#
+#   python benchmarks/template_latency.py abc222 a --repeat 5
+
+import argparse
+import statistics
+from time import perf_counter
+from atcoder_auto_submitter.atcoder import login, get_problem, get_problem_with_envgen
+
+
+def measure(f, contest_id, problem_id, repeat):
+  times = []
+  for _ in range(repeat):
+    started_at = perf_counter()
+    f(contest_id, problem_id)
+    times.append(perf_counter() - started_at)
+  return times
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark of template generation.')
+  parser.add_argument('contest_id', help='Contest ID (e.g. abc001)')
+  parser.add_argument('problem_id', help='Problem ID (e.g. a)')
+  parser.add_argument('--repeat', type=int, default=5, help='The number of measurements per path.')
+  args = parser.parse_args()
+
+  # Login is shared by both paths, so it is excluded from the measurement
+  login()
+
+  results = [
+      ('fast path', measure(get_problem, args.contest_id, args.problem_id, args.repeat)),
+      ('envgen', measure(get_problem_with_envgen, args.contest_id, args.problem_id, args.repeat)),
+  ]
+
+  print(f'{"path":<10} {"median":>8} {"min":>8} {"max":>8}')
+  for name, times in results:
+    print(f'{name:<10} {statistics.median(times):7.3f}s {min(times):7.3f}s {max(times):7.3f}s')
+
+
+if __name__ == '__main__':
+  main()